@@ -13,9 +13,16 @@
 #  - https://www.adafruit.com/datasheets/LIS3DH.pdf
 
 import logging
+import struct
+from time import sleep, time
 
-import Adafruit_GPIO.I2C as I2C
-import RPi.GPIO as GPIO  # needed for Hardware interrupt
+from gpio import GPIO  # needed for Hardware interrupt
+from i2c import InstrumentedTransport
+import metrics
+from utils import LazyModule
+
+I2C = LazyModule('Adafruit_GPIO.I2C')
+numpy = LazyModule('numpy')
 
 
 log = logging.getLogger(__name__)
@@ -40,6 +47,27 @@ class LIS3DH(object):
     DATARATE_LOWPOWER_1K6HZ = 0b1000  # Low power mode (1.6KHz)
     DATARATE_LOWPOWER_5KHZ = 0b1001  # Low power mode (5KHz) / Normal power mode (1.25KHz)
 
+    # Output data rate in Hz for each data rate setting, in normal / high resolution mode
+    DATARATE_HZ = {
+        DATARATE_POWERDOWN: 0,
+        DATARATE_1HZ: 1,
+        DATARATE_10HZ: 10,
+        DATARATE_25HZ: 25,
+        DATARATE_50HZ: 50,
+        DATARATE_100HZ: 100,
+        DATARATE_200HZ: 200,
+        DATARATE_400HZ: 400,
+        DATARATE_LOWPOWER_1K6HZ: 1600,
+        DATARATE_LOWPOWER_5KHZ: 1344,
+    }
+
+    # FIFO modes
+    FIFO_BYPASS = 0b00
+    FIFO_FIFO = 0b01  # Stops collecting when full
+    FIFO_STREAM = 0b10  # Keeps the newest samples, overwriting the oldest when full
+    FIFO_STREAM_TO_FIFO = 0b11
+    FIFO_SIZE = 32  # Number of samples the hardware FIFO holds
+
     # Registers
     REG_STATUS1 = 0x07
     REG_OUTADC1_L = 0x08
@@ -85,15 +113,57 @@ class LIS3DH(object):
     CLK_SINGLE = 0x01
     CLK_DOUBLE = 0x02
 
+    # INT1 threshold resolution in g per LSB, for each range
+    THRESHOLD_LSB = {
+        RANGE_2G: 0.016,
+        RANGE_4G: 0.032,
+        RANGE_8G: 0.062,
+        RANGE_16G: 0.186,
+    }
+    INT_ACTIVE = 0x40  # IA bit of REG_INT1SRC, set when an interrupt event has been generated
+
     AXIS_X = 0x00
     AXIS_Y = 0x01
     AXIS_Z = 0x02
 
-    def __init__(self, address=0x18, bus=-1):
+    AUTO_INCREMENT = 0x80  # Set on the register address to read consecutive registers in one transaction
+    MAX_BLOCK_BYTES = 32  # Largest block read supported by SMBus
+
+    # Configuration registers kept in a write-through shadow cache, as (first register, count) blocks
+    # INT1SRC and CLICKSRC are skipped, since reading them clears the latched interrupt
+    SHADOW_BLOCKS = (
+        (REG_TEMPCFG, 8),  # TEMPCFG, CTRL1-6, REFERENCE
+        (REG_FIFOCTRL, 1),
+        (REG_INT1CFG, 1),
+        (REG_INT1THS, 2),  # INT1THS, INT1DUR
+        (REG_CLICKCFG, 1),
+        (REG_CLICKTHS, 4),  # CLICKTHS, TIMELIMIT, TIMELATENCY, TIMEWINDOW
+    )
+
+    # With a bus_manager (i2c.I2CBusManager), the device handle is shared and its transactions serialized per bus.
+    # A transport (see i2c.I2CTransport, e.g. LinuxI2CTransport or SimulatedLIS3DH) replaces the Adafruit device.
+    def __init__(self, address=0x18, bus=-1, bus_manager=None, transport=None):
         log.debug("Initialising LIS3DH")
 
-        self.i2c = I2C.Device(address, busnum=bus)
+        if transport is not None:
+            self.i2c = transport
+        elif bus_manager is not None:
+            self.i2c = bus_manager.get_device(address, bus)
+        else:
+            self.i2c = I2C.Device(address, busnum=bus)
+        registry = metrics.get_registry()
+        if registry.enabled:
+            self.i2c = InstrumentedTransport(self.i2c, registry, bus, address)
+        self.overruns_counter = registry.counter(
+            'lis3dh_fifo_overruns_total', 'LIS3DH FIFO overruns, samples were lost', bus=bus,
+            address='0x{:02X}'.format(address)
+        )
+        self.max_block_bytes = getattr(self.i2c, 'max_block_bytes', self.MAX_BLOCK_BYTES)
         self.address = address
+        self.bus = bus
+        self.registers = {}  # shadow of the configuration registers, see SHADOW_BLOCKS
+        self.divisor = 1
+        self.fifo_overruns = 0
 
         try:
             val = self.i2c.readU8(self.REG_WHOAMI)
@@ -104,6 +174,8 @@ class LIS3DH(object):
         except Exception:
             raise Exception("Error establishing connection with LIS3DH")
 
+        self.resync()
+
         # Enable all axis
         self.set_axis_status(self.AXIS_X, True)
         self.set_axis_status(self.AXIS_Y, True)
@@ -127,6 +199,18 @@ class LIS3DH(object):
     def get_z(self):
         return self.get_axis(self.AXIS_Z)
 
+    # Get readings from all three axis in a single block read, as (x, y, z)
+    def get_xyz(self):
+        divisor = self.divisor
+        x, y, z = self.get_xyz_raw()
+        return float(x) / divisor, float(y) / divisor, float(z) / divisor
+
+    # Get raw (unscaled, two's complement) readings from all three axis in a single block read, as (x, y, z)
+    def get_xyz_raw(self):
+        # Reads REG_OUT_X_L..REG_OUT_Z_H with the auto-increment bit set, little endian 16-bit signed pairs
+        data = self.i2c.readList(self.REG_OUT_X_L | self.AUTO_INCREMENT, 6)
+        return struct.unpack('<hhh', bytes(bytearray(data)))
+
     # Get a reading from the desired axis
     def get_axis(self, axis):
         base = self.REG_OUT_X_L + (2 * axis)  # Determine which register we need to read from (2 per axis)
@@ -136,7 +220,14 @@ class LIS3DH(object):
         res = low | (high << 8)  # Combine the two components
         res = self.twos_comp(res)  # Calculate the twos compliment of the result
 
-        # Fetch the range we're set to, so we can accurately calculate the result
+        return float(res) / self.divisor
+
+    # Get the divisor that converts a raw reading to g, based on the range we're set to
+    def get_divisor(self):
+        return self.divisor
+
+    # Recalculate the divisor from the (shadowed) range, called whenever REG_CTRL4 is written
+    def _update_divisor(self):
         current_range = self.get_range()
         divisor = 1
         if current_range == self.RANGE_2G:
@@ -147,12 +238,11 @@ class LIS3DH(object):
             divisor = 4096
         elif current_range == self.RANGE_16G:
             divisor = 1365.33
-
-        return float(res) / divisor
+        self.divisor = divisor
 
     # Get the range that the sensor is currently set to
     def get_range(self):
-        val = self.i2c.readU8(self.REG_CTRL4)  # Get value from register
+        val = self.read_register(self.REG_CTRL4)  # Get value from register
         val = (val >> 4)  # Remove lowest 4 bits
         val &= 0b0011  # Mask off two highest bits
 
@@ -170,7 +260,7 @@ class LIS3DH(object):
         if new_range < 0 or new_range > 3:
             raise Exception("Tried to set invalid range")
 
-        val = self.i2c.readU8(self.REG_CTRL4)  # Get value from register
+        val = self.read_register(self.REG_CTRL4)  # Get value from register
         val &= ~0b110000  # Mask off lowest 4 bits
         val |= (new_range << 4)  # Write in our new range
         self.write_register(self.REG_CTRL4, val)  # Write back to register
@@ -181,18 +271,35 @@ class LIS3DH(object):
         if axis < 0 or axis > 2:
             raise Exception("Tried to modify invalid axis")
 
-        current = self.i2c.readU8(self.REG_CTRL1)
+        current = self.read_register(self.REG_CTRL1)
         final = self.set_bit(current, axis, int(enable))
         self.write_register(self.REG_CTRL1, final)
 
-    def set_interrupt(self, mycallback):
+    # mycallback(pin) runs once per batch of edges delivered by the GPIO backend, rather than once per edge
+    def set_interrupt(self, mycallback, pin=None):
+        pin = self.INT_IO if pin is None else pin
         GPIO.setmode(GPIO.BCM)
-        GPIO.setup(self.INT_IO, GPIO.IN)
-        GPIO.add_event_detect(self.INT_IO, GPIO.RISING, callback=mycallback)
+        GPIO.setup(pin, GPIO.IN)
+        GPIO.add_event_batch_detect(pin, GPIO.RISING, lambda events: mycallback(pin))
+
+    def clear_interrupt(self, pin=None):
+        GPIO.remove_event_detect(self.INT_IO if pin is None else pin)
+
+    # Route the data ready (DRDY) signal to INT1, raised every time a new sample is available
+    def set_data_ready_interrupt(self, enable=True):
+        val = self.read_register(self.REG_CTRL3)
+        final = self.set_bit(val, 4, int(enable))  # I1_ZYXDA is bit 5 of REG_CTRL3
+        self.write_register(self.REG_CTRL3, final)
+
+    # Route the FIFO watermark signal to INT1, raised while the FIFO holds more samples than the watermark
+    def set_fifo_watermark_interrupt(self, enable=True):
+        val = self.read_register(self.REG_CTRL3)
+        final = self.set_bit(val, 2, int(enable))  # I1_WTM is bit 3 of REG_CTRL3
+        self.write_register(self.REG_CTRL3, final)
 
     def set_click(self, clickmode, clickthresh=80, timelimit=10, timelatency=20, timewindow=100, mycallback=None):
         if clickmode == self.CLK_NONE:
-            val = self.i2c.readU8(self.REG_CTRL3)  # Get value from register
+            val = self.read_register(self.REG_CTRL3)  # Get value from register
             val &= ~0x80  # unset bit 8 to disable interrupt
             self.write_register(self.REG_CTRL3, val)  # Write back to register
             self.write_register(self.REG_CLICKCFG, 0)  # disable all interrupts
@@ -220,30 +327,203 @@ class LIS3DH(object):
         self.i2c.readU8(self.REG_INT1SRC)  # reset interrupt flag
         return reg
 
+    # Raise INT1 when the acceleration on any of the given axis goes above 'threshold' g for 'duration' samples
+    # With high_pass, the internal high-pass filter removes gravity (and slow drift) before comparing
+    # A threshold of None disables the motion interrupt
+    def set_motion_interrupt(self, threshold, duration=0, axes=(AXIS_X, AXIS_Y, AXIS_Z), high_pass=True):
+        val = self.read_register(self.REG_CTRL3)
+        if threshold is None:
+            self.write_register(self.REG_CTRL3, self.set_bit(val, 6, 0))  # I1_IA1 is bit 7 of REG_CTRL3
+            self.write_register(self.REG_INT1CFG, 0)
+            return
+        if any(axis < 0 or axis > 2 for axis in axes):
+            raise Exception("Tried to modify invalid axis")
+
+        ths = int(round(threshold / self.THRESHOLD_LSB[self.get_range()]))
+        self.write_register(self.REG_INT1THS, min(max(ths, 1), 0x7F))
+        self.write_register(self.REG_INT1DUR, min(max(int(duration), 0), 0x7F))
+
+        ctrl2 = self.set_bit(self.read_register(self.REG_CTRL2), 0, int(high_pass))  # HP_IA1 is bit 1 of REG_CTRL2
+        self.write_register(self.REG_CTRL2, ctrl2)
+        if high_pass:
+            self.i2c.readU8(self.REG_REFERENCE)  # Reading the reference register resets the filter
+
+        ctrl5 = self.set_bit(self.read_register(self.REG_CTRL5), 3, 1)  # latch interrupt on int1
+        self.write_register(self.REG_CTRL5, ctrl5)
+
+        cfg = 0
+        for axis in axes:
+            cfg |= 0x02 << (2 * axis)  # OR combination of high events, XHIE/YHIE/ZHIE
+        self.write_register(self.REG_INT1CFG, cfg)
+        self.write_register(self.REG_CTRL3, self.set_bit(val, 6, 1))
+
+    # Read (and so clear) the latched INT1 source, test against INT_ACTIVE for a motion event
+    def get_motion_source(self):
+        return self.i2c.readU8(self.REG_INT1SRC)
+
+    # Set the FIFO mode (bypass, FIFO, stream, stream-to-FIFO) and the watermark level (0-31)
+    def set_fifo_mode(self, mode, watermark=0):
+        if mode < 0 or mode > 3:
+            raise Exception("Tried to set invalid FIFO mode")
+        if watermark < 0 or watermark >= self.FIFO_SIZE:
+            raise Exception("Tried to set invalid FIFO watermark")
+
+        if self.get_fifo_mode() != self.FIFO_BYPASS:
+            self.write_register(self.REG_FIFOCTRL, 0)  # Pass through bypass mode to reset the FIFO
+        val = self.read_register(self.REG_CTRL5)
+        final = self.set_bit(val, 6, int(mode != self.FIFO_BYPASS))  # FIFO enable is bit 7 of REG_CTRL5
+        self.write_register(self.REG_CTRL5, final)
+        self.write_register(self.REG_FIFOCTRL, (mode << 6) | watermark)
+
+    # Get the FIFO mode that the sensor is currently set to
+    def get_fifo_mode(self):
+        return (self.read_register(self.REG_FIFOCTRL) >> 6) & 0b11
+
+    # Get the FIFO status as (number of unread samples, overrun flag, watermark flag)
+    def get_fifo_status(self):
+        val = self.i2c.readU8(self.REG_FIFOSRC)
+        overrun = bool(val & 0x40)
+        level = self.FIFO_SIZE if overrun else val & 0x1F
+        return level, overrun, bool(val & 0x80)
+
+    # Read 'count' raw (x, y, z) samples from the FIFO as a (count, 3) int16 array, using as few block reads as possible
+    def read_fifo_raw(self, count):
+        chunks = []
+        per_read = self.max_block_bytes // 6
+        while count > 0:
+            n = min(count, per_read)
+            # With the FIFO enabled, the address wraps back to REG_OUT_X_L after REG_OUT_Z_H
+            chunks.append(bytes(bytearray(self.i2c.readList(self.REG_OUT_X_L | self.AUTO_INCREMENT, 6 * n))))
+            count -= n
+        return numpy.frombuffer(b''.join(chunks), dtype='<i2').reshape(-1, 3)
+
+    # Get the number of unread samples in the FIFO, counting (and logging) overruns
+    def _fifo_level(self):
+        level, overrun, _ = self.get_fifo_status()
+        if overrun:
+            self.fifo_overruns += 1
+            self.overruns_counter.inc()
+            log.warning("LIS3DH FIFO overrun at address 0x%X, samples lost (%d overruns)" % (
+                self.address, self.fifo_overruns))
+        return level
+
+    # Drain the FIFO and return (timestamps, samples), as a (n,) array and a (n, 3) array in g, oldest first
+    # Timestamps are reconstructed from the drain time and the output data rate
+    def drain_fifo_array(self):
+        timestamps, raw = self.drain_fifo_raw()
+        return timestamps, raw / float(self.divisor)
+
+    # Same as drain_fifo_array, with the raw int16 samples (divide by get_divisor() for g)
+    def drain_fifo_raw(self):
+        level = self._fifo_level()
+        if not level:
+            return numpy.empty(0), numpy.empty((0, 3), dtype='<i2')
+        now = time()
+        period = 1.0 / (self.get_data_rate_hz() or 1)
+        timestamps = now - period * numpy.arange(level - 1, -1, -1)
+        return timestamps, self.read_fifo_raw(level)
+
+    # Drain the FIFO and return the samples in g, as a list of (timestamp, x, y, z), oldest first
+    def drain_fifo(self):
+        timestamps, samples = self.drain_fifo_array()
+        return [(t, x, y, z) for t, (x, y, z) in zip(timestamps.tolist(), samples.tolist())]
+
+    # Read the next 'n' consecutive samples through the FIFO, as a (n, 3) array in g
+    # If the FIFO is in bypass mode, stream mode is enabled for the duration of the read
+    def read_block(self, n):
+        bypass = self.get_fifo_mode() == self.FIFO_BYPASS
+        if bypass:
+            self.set_fifo_mode(self.FIFO_STREAM)
+        period = 1.0 / (self.get_data_rate_hz() or 1)
+        blocks = []
+        remaining = n
+        try:
+            while remaining > 0:
+                level = self._fifo_level()
+                if level:
+                    blocks.append(self.read_fifo_raw(min(level, remaining)))
+                    remaining -= len(blocks[-1])
+                if remaining > 0:
+                    sleep(min(remaining, self.FIFO_SIZE // 2) * period)
+        finally:
+            if bypass:
+                self.set_fifo_mode(self.FIFO_BYPASS)
+        if not blocks:
+            return numpy.empty((0, 3))
+        return numpy.concatenate(blocks) / float(self.divisor)
+
+    # Generator yielding (timestamp, x, y, z) samples in g, draining the FIFO in stream mode
+    # By default it wakes up every time the FIFO is expected to be half full; stops when stop_event is set
+    def stream(self, poll_seconds=None, stop_event=None):
+        if self.get_fifo_mode() != self.FIFO_STREAM:
+            self.set_fifo_mode(self.FIFO_STREAM)
+        if poll_seconds is None:
+            poll_seconds = (self.FIFO_SIZE // 2) / float(self.get_data_rate_hz() or 1)
+        while stop_event is None or not stop_event.is_set():
+            started = time()
+            for sample in self.drain_fifo():
+                yield sample
+            remaining = poll_seconds - (time() - started)
+            if remaining > 0:
+                if stop_event is None:
+                    sleep(remaining)
+                else:
+                    stop_event.wait(remaining)
+
+    # Get the output data rate in Hz that the sensor is currently set to
+    def get_data_rate_hz(self):
+        data_rate = self.read_register(self.REG_CTRL1) >> 4
+        if data_rate == self.DATARATE_LOWPOWER_5KHZ and self.read_register(self.REG_CTRL1) & 0b1000:
+            return 5376  # Low power mode
+        return self.DATARATE_HZ.get(data_rate, 0)
+
     # Set the rate (cycles per second) at which data is gathered
     def set_data_rate(self, data_rate):
-        val = self.i2c.readU8(self.REG_CTRL1)  # Get current value
+        val = self.read_register(self.REG_CTRL1)  # Get current value
         val &= 0b1111  # Mask off lowest 4 bits
         val |= (data_rate << 4)  # Write in our new data rate to highest 4 bits
         self.write_register(self.REG_CTRL1, val)  # Write back to register
 
     # Set whether we want to use high resolution or not
     def set_high_resolution(self, high_res=True):
-        val = self.i2c.readU8(self.REG_CTRL4)  # Get current value
+        val = self.read_register(self.REG_CTRL4)  # Get current value
         final = self.set_bit(val, 3, int(high_res))  # High resolution is bit 4 of REG_CTRL4
         self.write_register(self.REG_CTRL4, final)
 
     # Set whether we want to use block data update or not
     # False = output registers not updated until MSB and LSB reading
     def set_bdu(self, bdu=True):
-        val = self.i2c.readU8(self.REG_CTRL4)  # Get current value
+        val = self.read_register(self.REG_CTRL4)  # Get current value
         final = self.set_bit(val, 7, int(bdu))  # Block data update is bit 8 of REG_CTRL4
         self.write_register(self.REG_CTRL4, final)
 
-    # Write the given value to the given register
+    # Read the given register, served from the shadow cache for configuration registers
+    def read_register(self, register):
+        if register in self.registers:
+            return self.registers[register]
+        return self.i2c.readU8(register)
+
+    # Write the given value to the given register, keeping the shadow cache up to date
     def write_register(self, register, value):
         log.debug("WRT %s to register 0x%X" % (bin(value), register))
         self.i2c.write8(register, value)
+        if register in self.registers:
+            self.registers[register] = value & 0xFF
+            if register == self.REG_CTRL4:
+                self._update_divisor()
+
+    # Reload the shadow cache of configuration registers from the hardware
+    def resync(self):
+        registers = {}
+        for first, count in self.SHADOW_BLOCKS:
+            if count == 1:
+                registers[first] = self.i2c.readU8(first)
+            else:
+                data = bytearray(self.i2c.readList(first | self.AUTO_INCREMENT, count))
+                for offset in range(count):
+                    registers[first + offset] = data[offset]
+        self.registers = registers
+        self._update_divisor()
 
     # Set the bit at index 'bit' to 'value' on 'input_val' and return
     @staticmethod
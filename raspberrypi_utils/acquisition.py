@@ -0,0 +1,231 @@
+import ctypes
+import logging
+from multiprocessing import Event, Process, RawArray, RawValue
+import sys
+from time import sleep, time
+
+from capture import CaptureWriter, offline_sensor
+from LIS3DH import LIS3DH
+from utils import LazyModule
+
+numpy = LazyModule('numpy')
+
+
+log = logging.getLogger(__name__)
+
+
+def _read_counter(counter):
+    # a 64 bit store isn't atomic on 32 bit ARM, read until two reads agree
+    value = counter.value
+    while True:
+        again = counter.value
+        if again == value:
+            return value
+        value = again
+
+
+class SharedRing(object):
+    # Ring buffer of LIS3DH samples in shared memory, written by one process and read by any number of others
+    # without locks. The writer announces the slots it is about to fill by advancing 'writing', fills them, then
+    # publishes them by advancing 'sequence' (the number of samples ever written); readers (RingReader) keep their
+    # own position, and detect the samples the writer overwrote, or is overwriting, before they got to them.
+    # 'failed' is set if the acquisition stopped on an error. Create it before starting the processes, they inherit it.
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.samples = RawArray(ctypes.c_int16, capacity * 3)
+        self.timestamps = RawArray(ctypes.c_double, capacity)
+        self.sequence = RawValue(ctypes.c_uint64)
+        self.writing = RawValue(ctypes.c_uint64)
+        self.failed = RawValue(ctypes.c_bool)
+        # set by the acquisition process before the first sample
+        self.divisor = RawValue(ctypes.c_double, 1.0)  # counts per g of the samples
+        self.sensor_range = RawValue(ctypes.c_uint8)
+        self.data_rate_hz = RawValue(ctypes.c_uint16)
+        self.fifo_overruns = RawValue(ctypes.c_uint32)
+        self._views = None
+
+    def views(self):
+        # numpy views of the shared arrays, created once per process
+        if self._views is None:
+            self._views = (
+                numpy.frombuffer(self.timestamps, dtype=numpy.float64),
+                numpy.frombuffer(self.samples, dtype=numpy.int16).reshape(self.capacity, 3),
+            )
+        return self._views
+
+    def get_sequence(self):
+        return _read_counter(self.sequence)
+
+    def get_writing(self):
+        return _read_counter(self.writing)
+
+    def write(self, timestamps, raw):
+        # single writer only
+        timestamps_view, samples_view = self.views()
+        n = len(raw)
+        if n > self.capacity:
+            timestamps, raw, n = timestamps[-self.capacity:], raw[-self.capacity:], self.capacity
+        sequence = self.sequence.value
+        self.writing.value = sequence + n  # announce
+        start = sequence % self.capacity
+        first = min(n, self.capacity - start)
+        timestamps_view[start:start + first] = timestamps[:first]
+        samples_view[start:start + first] = raw[:first]
+        if first < n:
+            timestamps_view[:n - first] = timestamps[first:]
+            samples_view[:n - first] = raw[first:]
+        self.sequence.value = sequence + n  # publish
+
+
+class RingReader(object):
+    # One consumer's position in a SharedRing, starting with the samples written from now on (or the oldest still
+    # in the ring, with oldest=True). lost counts the samples overwritten before they could be read.
+    def __init__(self, ring, oldest=False):
+        self.ring = ring
+        sequence = ring.get_sequence()
+        self.position = max(0, sequence - ring.capacity) if oldest else sequence
+        self.lost = 0
+
+    def available(self):
+        return self.ring.get_sequence() - self.position
+
+    def read(self, max_samples=None):
+        # (timestamps, raw) of the next samples, as zero-copy views of the ring when they don't wrap around its end
+        # (a copy otherwise). Views stay valid until the writer has written another 'capacity - available()'
+        # samples, copy them to keep them longer.
+        ring = self.ring
+        sequence = ring.get_sequence()
+        # slots up to 'writing' may be being overwritten right now
+        writing = ring.get_writing()
+        if writing - self.position > ring.capacity:
+            lost = writing - self.position - ring.capacity
+            self.lost += lost
+            self.position += lost
+            log.warning('RingReader: {} samples overwritten before being read ({} in total)'.format(lost, self.lost))
+        n = sequence - self.position
+        if max_samples is not None:
+            n = min(n, max_samples)
+        timestamps_view, samples_view = ring.views()
+        start = self.position % ring.capacity
+        if start + n <= ring.capacity:
+            timestamps, raw = timestamps_view[start:start + n], samples_view[start:start + n]
+        else:
+            end = start + n - ring.capacity
+            timestamps = numpy.concatenate((timestamps_view[start:], timestamps_view[:end]))
+            raw = numpy.concatenate((samples_view[start:], samples_view[:end]))
+        # the writer may have lapped us while slicing, drop what it overwrote or started overwriting
+        overwritten = min(n, ring.get_writing() - ring.capacity - self.position)
+        if overwritten > 0:
+            self.lost += overwritten
+            timestamps, raw = timestamps[overwritten:], raw[overwritten:]
+        self.position += n
+        return timestamps, raw
+
+    def read_g(self, max_samples=None):
+        timestamps, raw = self.read(max_samples)
+        return timestamps, raw / self.ring.divisor.value
+
+
+def _acquire(ring, stop_event, address, bus, data_rate, sensor_range, transport_factory):
+    # the process exits with 1 after an error, and sets ring.failed so that the consumers know no more is coming
+    try:
+        _acquire_samples(ring, stop_event, address, bus, data_rate, sensor_range, transport_factory)
+    except Exception:
+        log.exception('LIS3DH acquisition failed at address 0x{:X} on bus {}'.format(address, bus))
+        ring.failed.value = True
+        sys.exit(1)
+
+
+def _acquire_samples(ring, stop_event, address, bus, data_rate, sensor_range, transport_factory):
+    sensor = LIS3DH(address=address, bus=bus, transport=transport_factory() if transport_factory else None)
+    if data_rate is not None:
+        sensor.set_data_rate(data_rate)
+    if sensor_range is not None:
+        sensor.set_range(sensor_range)
+    ring.divisor.value = sensor.get_divisor()
+    ring.sensor_range.value = sensor.get_range()
+    ring.data_rate_hz.value = sensor.get_data_rate_hz()
+    sensor.set_fifo_mode(LIS3DH.FIFO_STREAM)
+    poll_seconds = (LIS3DH.FIFO_SIZE // 2) / float(sensor.get_data_rate_hz() or 1)
+    while not stop_event.is_set():
+        started = time()
+        timestamps, raw = sensor.drain_fifo_raw()
+        if len(raw):
+            ring.write(timestamps, raw)
+        ring.fifo_overruns.value = sensor.fifo_overruns
+        sleep(max(0, poll_seconds - (time() - started)))
+    sensor.set_fifo_mode(LIS3DH.FIFO_BYPASS)
+
+
+class AcquisitionProcess(object):
+    # Runs LIS3DH acquisition in its own process, draining the FIFO into a SharedRing, so that sampling timing is
+    # isolated from the load (and the GIL) of the processes consuming the samples. transport_factory(), called in the
+    # acquisition process, creates the sensor's I2C transport (Adafruit_GPIO by default).
+    def __init__(self, ring=None, address=0x18, bus=-1, data_rate=None, sensor_range=None, transport_factory=None):
+        self.ring = SharedRing() if ring is None else ring
+        self.stop_event = Event()
+        self.process = Process(
+            target=_acquire, name='LIS3DH-acquisition',
+            args=(self.ring, self.stop_event, address, bus, data_rate, sensor_range, transport_factory)
+        )
+        self.process.daemon = True
+
+    def start(self):
+        self.process.start()
+
+    def stop(self, timeout=None):
+        self.stop_event.set()
+        self.process.join(timeout)
+
+    def is_running(self):
+        return self.process.is_alive()
+
+    def failed(self):
+        # True if the acquisition stopped on an error (see the log of the acquisition process)
+        return self.ring.failed.value or self.process.exitcode not in (None, 0)
+
+
+def detect(ring, sensor=None, stop_event=None, poll_seconds=0.04, **sensor_kwargs):
+    # Consumer running VibrationSensor detection on the samples of a ring, until stop_event is set; meant as the
+    # target of a consumer process. The sensor defaults to capture.offline_sensor(**sensor_kwargs), calibrated on
+    # the first calibration_samples samples if auto_calibrate is set.
+    auto_calibrate = sensor_kwargs.pop('auto_calibrate', True)
+    calibration_samples = sensor_kwargs.pop('calibration_samples', 128)
+    if sensor is None:
+        sensor = offline_sensor(**sensor_kwargs)
+    reader = RingReader(ring)
+    calibration = []
+    calibrated = 0 if auto_calibrate else calibration_samples
+    while stop_event is None or not stop_event.is_set():
+        sleep(poll_seconds)
+        if ring.failed.value and not reader.available():
+            log.error('detect: the acquisition failed, stopping')
+            break
+        _, block = reader.read_g()
+        if calibrated < calibration_samples:
+            calibration.append(block[:calibration_samples - calibrated].copy())
+            calibrated += len(calibration[-1])
+            if calibrated >= calibration_samples:
+                sensor.calibrate_block(numpy.concatenate(calibration))
+            continue
+        sensor.process_block(block)
+    return sensor
+
+
+def record(ring, path, stop_event, poll_seconds=0.1):
+    # Consumer writing the samples of a ring to a capture file (see capture.CaptureWriter), until stop_event is set
+    reader = RingReader(ring)
+    while not reader.available():  # the sensor settings are known once the acquisition is running
+        if stop_event.wait(poll_seconds) or ring.failed.value:
+            return 0
+    with CaptureWriter(path, ring.sensor_range.value, ring.data_rate_hz.value, ring.divisor.value) as writer:
+        while not stop_event.is_set():
+            timestamps, raw = reader.read()
+            if len(raw):
+                writer.write(timestamps, raw)
+            elif ring.failed.value:
+                log.error('record: the acquisition failed, stopping')
+                break
+            sleep(poll_seconds)
+        writer.flush()
+        return writer.count
@@ -0,0 +1,359 @@
+import argparse
+from collections import OrderedDict
+import json
+import logging
+import math
+import os
+import platform
+import sys
+import threading
+from time import sleep, time
+
+from gpio import GPIO
+from i2c import SimulatedLIS3DH
+from input_devices import LightSensor, VibrationSensor
+from LIS3DH import LIS3DH
+from output_devices import LED, Sequencer
+from runtime import DeviceRuntime
+
+
+log = logging.getLogger(__name__)
+
+
+# Benchmarks of the sensing and actuation hot paths, on simulated hardware (i2c.SimulatedLIS3DH and gpio.FakeGPIO)
+# so that they run anywhere, with machine-readable results to compare versions:
+#   python -m raspberrypi_utils.benchmark [--duration 2] [--json results.json] [--label v0.3.0] [name ...]
+# process_cpu_percent is the CPU of the whole process over the benchmark, not of the device alone: it includes the
+# simulated hardware's own thread. threads is the peak number of threads the benchmark added; every benchmark
+# joins its threads before the next one starts.
+BENCHMARKS = OrderedDict()
+
+INTERRUPT_PIN = 4
+LIGHT_PIN = 18
+LED_PIN = 17
+
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def _summary(values, scale=1000.0):
+    # mean, p50, p95 and max, by default from seconds to milliseconds
+    if not values:
+        return None
+    return {
+        'mean': scale * sum(values) / len(values),
+        'p50': scale * _percentile(values, 0.5),
+        'p95': scale * _percentile(values, 0.95),
+        'max': scale * max(values),
+        'count': len(values),
+    }
+
+
+def _jitter(timestamps, expected_seconds):
+    # deviation of the intervals between consecutive timestamps from the expected period, in milliseconds
+    intervals = [b - a for a, b in zip(timestamps, timestamps[1:])]
+    if not intervals:
+        return None
+    mean = sum(intervals) / len(intervals)
+    return {
+        'expected_ms': 1000.0 * expected_seconds,
+        'mean_ms': 1000.0 * mean,
+        'std_ms': 1000.0 * math.sqrt(sum((i - mean) ** 2 for i in intervals) / len(intervals)),
+        'max_deviation_ms': 1000.0 * max(abs(i - expected_seconds) for i in intervals),
+    }
+
+
+class Probe(object):
+    # wall time, process CPU time and extra threads over a benchmark, created before any of its devices
+    def __init__(self):
+        self.threads = threading.active_count()
+        self.peak_threads = 0
+        self.start = time()
+        self.start_cpu = sum(os.times()[:2])
+
+    def sample_threads(self):
+        self.peak_threads = max(self.peak_threads, threading.active_count() - self.threads)
+
+    def result(self, **results):
+        elapsed = time() - self.start
+        results['seconds'] = elapsed
+        results['process_cpu_percent'] = 100.0 * (sum(os.times()[:2]) - self.start_cpu) / elapsed
+        results['threads'] = self.peak_threads
+        return results
+
+
+class _ManualClock(object):
+    def __init__(self):
+        self.now = time()
+
+    def __call__(self):
+        return self.now
+
+
+class _Bursts(object):
+    # signal for SimulatedLIS3DH: 1g on z, plus a burst of vibration on x for burst_seconds every period_seconds
+    def __init__(self, start, period_seconds=0.5, burst_seconds=0.1, amplitude_g=0.5, frequency_hz=80):
+        self.start = start
+        self.period_seconds = period_seconds
+        self.burst_seconds = burst_seconds
+        self.amplitude_g = amplitude_g
+        self.frequency_hz = frequency_hz
+
+    def __call__(self, t):
+        if t >= self.start and (t - self.start) % self.period_seconds < self.burst_seconds:
+            return self.amplitude_g * math.sin(2 * math.pi * self.frequency_hz * t), 0.0, 1.0
+        return 0.0, 0.0, 1.0
+
+    def latencies(self, detections, until):
+        # from the start of every burst to the first detection reported after it
+        latencies = []
+        burst = self.start
+        detections = [t for t, vibration in detections if vibration]
+        while burst + self.period_seconds <= until:
+            following = [t - burst for t in detections if burst <= t < burst + self.period_seconds]
+            if following:
+                latencies.append(following[0])
+            burst += self.period_seconds
+        return latencies
+
+
+@benchmark('lis3dh.get_axis')
+def bench_get_axis(duration):
+    probe = Probe()
+    sim = SimulatedLIS3DH()
+    sensor = LIS3DH(transport=sim)
+    transactions = sim.transactions
+    reads = 0
+    deadline = time() + duration
+    while time() < deadline:
+        for i in xrange(100):
+            sensor.get_axis(i % 3)
+        reads += 100
+    return probe.result(
+        reads_per_second=reads / (time() - probe.start),
+        transactions_per_read=float(sim.transactions - transactions) / reads,
+    )
+
+
+def _drain(duration, max_block_bytes):
+    # FIFO reads at the highest rate the host can sustain, on a simulated clock advanced by one full FIFO every time
+    probe = Probe()
+    clock = _ManualClock()
+    sim = SimulatedLIS3DH(clock=clock)
+    sim.max_block_bytes = max_block_bytes
+    sensor = LIS3DH(transport=sim)
+    sensor.set_fifo_mode(LIS3DH.FIFO_STREAM)
+    period = 1.0 / sensor.get_data_rate_hz()
+    transactions = sim.transactions
+    samples = 0
+    deadline = time() + duration
+    while time() < deadline:
+        clock.now += (LIS3DH.FIFO_SIZE - 1) * period
+        _, block = sensor.drain_fifo_array()
+        samples += len(block)
+    return probe.result(
+        samples_per_second=samples / (time() - probe.start),
+        transactions_per_sample=float(sim.transactions - transactions) / max(samples, 1),
+        fifo_overruns=sensor.fifo_overruns,
+    )
+
+
+@benchmark('lis3dh.drain_fifo')
+def bench_drain_fifo(duration):
+    return _drain(duration, SimulatedLIS3DH.max_block_bytes)
+
+
+@benchmark('lis3dh.drain_fifo_smbus')
+def bench_drain_fifo_smbus(duration):
+    return _drain(duration, LIS3DH.MAX_BLOCK_BYTES)
+
+
+def _vibration(duration, mode, frequency_seconds, runtime=False):
+    probe = Probe()
+    detections = []
+    bursts = _Bursts(time() + 0.2)
+    sim = SimulatedLIS3DH(signal=bursts)
+    sim.int1_callbacks.append(lambda sim: GPIO.pulse(INTERRUPT_PIN))
+    device_runtime = DeviceRuntime(name='benchmark') if runtime else None
+    sensor = VibrationSensor(
+        frequency_seconds=frequency_seconds,
+        auto_calibrate=False,
+        vibration_callback=lambda vibration: detections.append((time(), vibration)),
+        mode=mode,
+        interrupt_pin=INTERRUPT_PIN,
+        calibration_cache=None,
+        runtime=device_runtime,
+        transport=sim,
+    )
+    sensor.calibration = (0.0, 0.0, 1.0)
+    if mode != VibrationSensor.MODE_POLL:
+        sim.start(tick_seconds=0.002)
+    if device_runtime is not None:
+        device_runtime.start()
+    samples_read = sim.samples_read
+    transactions = sim.transactions
+    deadline = time() + duration
+    while time() < deadline:
+        probe.sample_threads()
+        sleep(0.1)
+    if device_runtime is not None:
+        device_runtime.stop()
+    else:
+        sensor.stop()
+        sensor.thread.join()
+    sim.stop()
+    samples = sim.samples_read - samples_read
+    transactions = sim.transactions - transactions
+    results = probe.result(
+        samples_per_second=samples / (time() - probe.start),
+        transactions_per_second=transactions / (time() - probe.start),
+        transactions_per_sample=float(transactions) / samples if samples else None,  # motion reads no samples
+        detection_latency_ms=_summary(bursts.latencies(detections, deadline)),
+    )
+    if mode == VibrationSensor.MODE_POLL:
+        results['loop_jitter'] = _jitter([t for t, _ in detections], frequency_seconds)
+    return results
+
+
+@benchmark('vibration.poll')
+def bench_vibration_poll(duration):
+    return _vibration(duration, VibrationSensor.MODE_POLL, 0.01)
+
+
+@benchmark('vibration.poll_runtime')
+def bench_vibration_poll_runtime(duration):
+    return _vibration(duration, VibrationSensor.MODE_POLL, 0.01, runtime=True)
+
+
+@benchmark('vibration.interrupt')
+def bench_vibration_interrupt(duration):
+    return _vibration(duration, VibrationSensor.MODE_INTERRUPT, 1, runtime=True)
+
+
+@benchmark('vibration.motion')
+def bench_vibration_motion(duration):
+    return _vibration(duration, VibrationSensor.MODE_MOTION, 1, runtime=True)
+
+
+def _light(duration, mode):
+    probe = Probe()
+    GPIO.set_charge_time(LIGHT_PIN, 0.002)
+    sensor = LightSensor(LIGHT_PIN, None, frequency=3600, runtime=DeviceRuntime(), mode=mode)  # never started
+    durations = []
+    deadline = time() + duration
+    while time() < deadline:
+        start = time()
+        sensor.read()
+        durations.append(time() - start - 0.1)  # without the fixed discharge time
+        probe.sample_threads()
+    return probe.result(read_ms=_summary(durations))
+
+
+@benchmark('light.count')
+def bench_light_count(duration):
+    return _light(duration, LightSensor.MODE_COUNT)
+
+
+@benchmark('light.timed')
+def bench_light_timed(duration):
+    return _light(duration, LightSensor.MODE_TIMED)
+
+
+def _led(duration, sequenced=False):
+    probe = Probe()
+    on_seconds = off_seconds = 0.01
+    sequencer = Sequencer() if sequenced else None
+    led = LED(LED_PIN, sequencer=sequencer)
+    GPIO.history.clear()
+    led.flash(on_seconds, off_seconds)
+    deadline = time() + duration
+    while time() < deadline:
+        probe.sample_threads()
+        sleep(0.1)
+    led.off()
+    if sequencer is not None:
+        sequencer.shutdown()
+    writes = [t for t, pin, _ in GPIO.history if pin == LED_PIN][:-1]
+    return probe.result(
+        transitions_per_second=len(writes) / (time() - probe.start),
+        transition_jitter=_jitter(writes, on_seconds),
+    )
+
+
+@benchmark('led.flash')
+def bench_led_flash(duration):
+    return _led(duration)
+
+
+@benchmark('led.sequencer')
+def bench_led_sequencer(duration):
+    return _led(duration, sequenced=True)
+
+
+def _wait_for_threads(count, timeout=1.0):
+    # short-lived helper threads (FakeGPIO's charge timers) may still be finishing
+    deadline = time() + timeout
+    while threading.active_count() > count and time() < deadline:
+        sleep(0.01)
+    return threading.active_count() - count
+
+
+def run(names=None, duration=2.0):
+    GPIO.use('fake')
+    results = OrderedDict()
+    threads = threading.active_count()
+    for name, func in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+        log.info('Running {}'.format(name))
+        results[name] = func(duration)
+        leftover = _wait_for_threads(threads)
+        if leftover > 0:
+            log.warning('{} left {} threads running, thread counts of the next benchmarks are off'.format(
+                name, leftover))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark raspberrypi_utils on simulated hardware')
+    parser.add_argument('names', nargs='*', help='benchmarks to run, all by default: {}'.format(
+        ', '.join(BENCHMARKS)))
+    parser.add_argument('--duration', type=float, default=2.0, help='seconds per benchmark')
+    parser.add_argument('--json', help='write the results to this file, - for stdout')
+    parser.add_argument('--label', help='stored with the results, e.g. the version being measured')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error('unknown benchmarks: {}'.format(', '.join(unknown)))
+    report = OrderedDict([
+        ('label', args.label),
+        ('timestamp', time()),
+        ('python', platform.python_version()),
+        ('machine', platform.machine()),
+        ('duration_seconds', args.duration),
+        ('benchmarks', run(args.names, args.duration)),
+    ])
+    if args.json == '-':
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    elif args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.json != '-':
+        for name, results in report['benchmarks'].items():
+            sys.stdout.write('{}: {}\n'.format(name, json.dumps(results, sort_keys=True)))
+
+
+if __name__ == '__main__':
+    main()
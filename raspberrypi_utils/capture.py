@@ -0,0 +1,244 @@
+import logging
+import mmap
+import os
+import struct
+from time import sleep, time
+
+from i2c import SimulatedLIS3DH
+from input_devices import VibrationSensor
+from LIS3DH import LIS3DH
+from utils import LazyModule
+
+numpy = LazyModule('numpy')
+
+
+log = logging.getLogger(__name__)
+
+
+# Capture files of raw LIS3DH samples:
+#   header: magic, version, range (LIS3DH.RANGE_*), output data rate in Hz, counts per g (LIS3DH divisor),
+#           start time, samples per chunk (padded to 32 bytes)
+#   chunks: a chunk header with the chunk's base time and sample count, followed by fixed 10 byte records of the
+#           time since the base time in microseconds (uint32) and the raw x, y, z (int16), all little endian
+HEADER = struct.Struct('<8sHBHfdI3x')
+CHUNK_HEADER = struct.Struct('<dI')
+MAGIC = b'LIS3DHCP'
+VERSION = 1
+RECORD_DTYPE = [('dt_us', '<u4'), ('xyz', '<i2', (3,))]
+
+
+class CaptureWriter(object):
+    # Appends (timestamps, raw samples) blocks to a capture file, one chunk every chunk_samples samples
+    def __init__(self, path, range_g, data_rate_hz, divisor, chunk_samples=1024, start_time=None):
+        self.path = path
+        self.range_g = range_g
+        self.data_rate_hz = data_rate_hz
+        self.divisor = divisor
+        self.chunk_samples = chunk_samples
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(
+            MAGIC, VERSION, range_g, data_rate_hz, divisor, time() if start_time is None else start_time,
+            chunk_samples
+        ))
+        self.timestamps = []
+        self.samples = []
+        self.pending = 0
+        self.count = 0
+
+    @classmethod
+    def for_sensor(cls, path, sensor, chunk_samples=1024):
+        return cls(path, sensor.get_range(), sensor.get_data_rate_hz(), sensor.get_divisor(), chunk_samples)
+
+    def write(self, timestamps, raw):
+        # timestamps: (n,) in seconds, raw: (n, 3) int16 as returned by LIS3DH.drain_fifo_raw
+        self.timestamps.append(numpy.asarray(timestamps, dtype=float))
+        self.samples.append(numpy.asarray(raw, dtype='<i2'))
+        self.pending += len(raw)
+        while self.pending >= self.chunk_samples:
+            self._write_chunk(self.chunk_samples)
+
+    def _write_chunk(self, n):
+        timestamps = numpy.concatenate(self.timestamps)
+        samples = numpy.concatenate(self.samples)
+        records = numpy.empty(n, dtype=RECORD_DTYPE)
+        base = timestamps[0]
+        records['dt_us'] = numpy.round((timestamps[:n] - base) * 1e6)
+        records['xyz'] = samples[:n]
+        self.file.write(CHUNK_HEADER.pack(base, n))
+        self.file.write(records.tobytes())
+        self.timestamps = [timestamps[n:]]
+        self.samples = [samples[n:]]
+        self.pending -= n
+        self.count += n
+
+    def flush(self):
+        if self.pending:
+            self._write_chunk(self.pending)
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def record(sensor, path, seconds=None, stop_event=None, chunk_samples=1024):
+    # capture a LIS3DH (the sensor of a VibrationSensor, for instance) into path, draining its FIFO in stream mode,
+    # for 'seconds' or until stop_event is set; returns the number of samples captured
+    if sensor.get_fifo_mode() != LIS3DH.FIFO_STREAM:
+        sensor.set_fifo_mode(LIS3DH.FIFO_STREAM)
+    poll_seconds = (LIS3DH.FIFO_SIZE // 2) / float(sensor.get_data_rate_hz() or 1)
+    deadline = None if seconds is None else time() + seconds
+    with CaptureWriter.for_sensor(path, sensor, chunk_samples) as writer:
+        while (deadline is None or time() < deadline) and (stop_event is None or not stop_event.is_set()):
+            started = time()
+            timestamps, raw = sensor.drain_fifo_raw()
+            if len(raw):
+                writer.write(timestamps, raw)
+            sleep(max(0, poll_seconds - (time() - started)))
+        writer.flush()
+        return writer.count
+
+
+class CaptureReader(object):
+    # Memory-maps a capture file; chunks() yields zero-copy numpy views of the records
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        if size < HEADER.size:
+            self.file.close()
+            raise ValueError('{} is not a capture file'.format(path))
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.range_g, self.data_rate_hz, self.divisor, self.start_time,
+         self.chunk_samples) = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('{} is not a version {} capture file'.format(path, VERSION))
+        self.record_dtype = numpy.dtype(RECORD_DTYPE)
+        self.index = []  # (base time, sample count, records offset)
+        offset = HEADER.size
+        while offset + CHUNK_HEADER.size <= size:
+            base, count = CHUNK_HEADER.unpack_from(self.map, offset)
+            offset += CHUNK_HEADER.size
+            if offset + count * self.record_dtype.itemsize > size:
+                log.warning('CaptureReader: {} is truncated, ignoring its last chunk'.format(path))
+                break
+            self.index.append((base, count, offset))
+            offset += count * self.record_dtype.itemsize
+
+    def __len__(self):
+        return sum(count for _, count, _ in self.index)
+
+    def duration(self):
+        if not self.index:
+            return 0.0
+        timestamps, _ = self._chunk(self.index[-1])
+        return timestamps[-1] - self.index[0][0]
+
+    def _chunk(self, entry):
+        base, count, offset = entry
+        records = numpy.frombuffer(self.map, dtype=self.record_dtype, count=count, offset=offset)
+        return base + records['dt_us'] * 1e-6, records['xyz']
+
+    def chunks(self):
+        # (timestamps, raw) per chunk, raw a (n, 3) int16 view into the file
+        for entry in self.index:
+            yield self._chunk(entry)
+
+    def read(self, samples=None):
+        # the first 'samples' (all by default) as (timestamps, samples in g)
+        chunks = []
+        remaining = len(self) if samples is None else samples
+        for timestamps, raw in self.chunks():
+            if remaining <= 0:
+                break
+            chunks.append((timestamps[:remaining], raw[:remaining]))
+            remaining -= len(raw)
+        if not chunks:
+            return numpy.empty(0), numpy.empty((0, 3))
+        timestamps, raw = zip(*chunks)
+        return numpy.concatenate(timestamps), numpy.concatenate(raw) / float(self.divisor)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ReplayClock(object):
+    # time as seen by a replayed sensor: the timestamp of the samples being replayed
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def offline_sensor(**kwargs):
+    # a VibrationSensor that only processes what replay feeds it: on a simulated LIS3DH, no thread, runtime or GPIO
+    kwargs.setdefault('calibration_cache', None)
+    kwargs.setdefault('auto_calibrate', False)
+    return VibrationSensor(transport=SimulatedLIS3DH(), acquire=False, **kwargs)
+
+
+def replay(reader, sensor=None, speed=None, block_samples=16, calibration_samples=128, **sensor_kwargs):
+    # Feed a capture (a CaptureReader or a path) through the detection path of sensor (offline_sensor(**sensor_kwargs)
+    # by default) in blocks of block_samples, as the FIFO watermark interrupt would. The sensor's meter and periodic
+    # reads follow the capture's timestamps, so speed=None replays as fast as possible, speed=10 ten times faster
+    # than real time. Unless the sensor was given, it is calibrated on the first calibration_samples samples.
+    # A given sensor gets its own clock back afterwards, its meter is reset before and after the replay.
+    # Returns a summary of what the callbacks were notified of.
+    if not isinstance(reader, CaptureReader):
+        reader = CaptureReader(reader)
+    if sensor is None:
+        sensor = offline_sensor(**sensor_kwargs)
+        if calibration_samples:
+            sensor.calibrate_block(reader.read(calibration_samples)[1])
+    clock = ReplayClock(reader.index[0][0] if reader.index else 0.0)
+    saved_clock, saved_last_read = sensor.meter.clock, sensor.last_read
+    sensor.meter.clock = clock
+    sensor.meter.reset()
+    sensor.last_read = clock.now
+    try:
+        return _replay(reader, sensor, clock, speed, block_samples)
+    finally:
+        sensor.meter.clock = saved_clock
+        sensor.meter.reset()
+        sensor.last_read = saved_last_read
+
+
+def _replay(reader, sensor, clock, speed, block_samples):
+    summary = {'samples': 0, 'blocks': 0, 'vibration_blocks': 0, 'max_rate': 0.0}
+    next_rate = clock.now + 1  # the rate only changes once per meter tick
+    started = time()
+    divisor = float(reader.divisor)
+    for timestamps, raw in reader.chunks():
+        for start in xrange(0, len(raw), block_samples):
+            block = raw[start:start + block_samples] / divisor
+            clock.now = timestamps[min(start + block_samples, len(raw)) - 1]
+            if speed:
+                delay = (clock.now - reader.index[0][0]) / speed - (time() - started)
+                if delay > 0:
+                    sleep(delay)
+            exceeding_before = sensor.meter.get_count()
+            sensor.process_block(block, now=clock.now)
+            summary['samples'] += len(block)
+            summary['blocks'] += 1
+            if sensor.meter.get_count() > exceeding_before:
+                summary['vibration_blocks'] += 1
+            if clock.now >= next_rate:
+                next_rate = clock.now + 1
+                summary['max_rate'] = max(summary['max_rate'], sensor.meter.get_rate(sensor.rate_window_seconds))
+    summary['rate'] = sensor.meter.get_rate(sensor.rate_window_seconds)
+    summary['seconds'] = time() - started
+    return summary
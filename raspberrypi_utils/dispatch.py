@@ -0,0 +1,158 @@
+from collections import deque
+import logging
+from threading import Condition, Thread
+from time import time
+
+import metrics
+
+
+log = logging.getLogger(__name__)
+
+
+def _coalescable(args):
+    return all(arg is False for arg in args)
+
+
+class EventChannel(object):
+    # Bounded queue of pending callbacks for one kind of event of one device, delivered in order
+    __slots__ = (
+        'name', 'maxsize', 'policy', 'pending', 'scheduled', 'submitted', 'delivered', 'dropped', 'dropped_counter',
+        'duration',
+    )
+
+    def __init__(self, name, maxsize, policy, dropped_counter, duration):
+        self.name = name
+        self.maxsize = maxsize
+        self.policy = policy
+        self.pending = deque()
+        self.scheduled = False  # queued for, or being run by, a worker
+        self.submitted = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.dropped_counter = dropped_counter
+        self.duration = duration  # callback run time histogram
+
+
+class CallbackDispatcher(object):
+    # Runs device callbacks on a small pool of worker threads, so that sampling never waits for a slow callback
+    # (sending an email, network I/O). Every device and event ('immediate', 'threshold', ...) gets its own bounded
+    # channel; when a channel is full, its policy decides which events are dropped, and drops are counted.
+    # A device can set the policy of its own events with a dispatch_policies dict ({event: policy}).
+    # Events of one channel are delivered in order, never concurrently.
+    DROP_NEWEST = 'drop_newest'
+    DROP_OLDEST = 'drop_oldest'
+    # coalesce per sample notifications: a new event replaces the pending ones whose arguments are all False (no
+    # vibration), but never one that reported something (a True), those are queued as with DROP_OLDEST
+    KEEP_LATEST = 'keep_latest'
+
+    def __init__(self, workers=2, maxsize=10, policy=DROP_OLDEST, name='CallbackDispatcher'):
+        self.maxsize = maxsize
+        self.policy = policy
+        self.name = name
+        self.condition = Condition()
+        self.channels = {}
+        self.ready = deque()  # channels with pending events
+        self.running = True
+        self.metrics = metrics.get_registry()
+        self.threads = []
+        for i in xrange(workers):
+            thread = Thread(target=self._run, name='{}-{}'.format(name, i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def configure(self, device, event, maxsize=None, policy=None):
+        with self.condition:
+            channel = self._channel(device, event)
+            if maxsize is not None:
+                channel.maxsize = maxsize
+            if policy is not None:
+                channel.policy = policy
+
+    def _channel(self, device, event):
+        key = (id(device), event)
+        channel = self.channels.get(key)
+        if channel is None:
+            labels = dict(dispatcher=self.name, device=getattr(device, 'metrics_label', type(device).__name__),
+                          event=event)
+            channel = EventChannel(
+                '{}-{:x}.{}'.format(type(device).__name__, id(device), event),
+                self.maxsize,
+                getattr(device, 'dispatch_policies', {}).get(event, self.policy),
+                self.metrics.counter('dispatcher_dropped_events_total', 'Events dropped by full channels', **labels),
+                self.metrics.histogram('callback_seconds', 'Callback run time', **labels) if self.metrics.enabled
+                else None
+            )
+            self.channels[key] = channel
+        return channel
+
+    def submit(self, device, event, callback, args=()):
+        # queue callback(*args), returns False if the event was dropped
+        with self.condition:
+            channel = self._channel(device, event)
+            channel.submitted += 1
+            pending = channel.pending
+            if channel.policy == self.KEEP_LATEST and pending:
+                kept = [event for event in pending if not _coalescable(event[1])]
+                if len(kept) < len(pending):
+                    channel.dropped += len(pending) - len(kept)
+                    channel.dropped_counter.inc(len(pending) - len(kept))
+                    pending.clear()
+                    pending.extend(kept)
+            if len(pending) >= channel.maxsize:
+                channel.dropped += 1
+                channel.dropped_counter.inc()
+                if channel.policy == self.DROP_NEWEST:
+                    return False
+                pending.popleft()
+            pending.append((callback, args))
+            if not channel.scheduled:
+                channel.scheduled = True
+                self.ready.append(channel)
+                self.condition.notify()
+        return True
+
+    def stats(self):
+        with self.condition:
+            return dict(
+                (channel.name, {
+                    'pending': len(channel.pending),
+                    'submitted': channel.submitted,
+                    'delivered': channel.delivered,
+                    'dropped': channel.dropped,
+                })
+                for channel in self.channels.values()
+            )
+
+    def stop(self, timeout=None):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.ready:
+                    self.condition.wait()
+                if not self.ready:
+                    return
+                channel = self.ready.popleft()
+                callback, args = channel.pending.popleft()
+            try:
+                if channel.duration is not None:
+                    start = time()
+                    callback(*args)
+                    channel.duration.observe(time() - start)
+                else:
+                    callback(*args)
+            except Exception:
+                log.exception('{}: error in {} callback'.format(self.name, channel.name))
+            with self.condition:
+                channel.delivered += 1
+                if channel.pending:
+                    self.ready.append(channel)
+                    self.condition.notify()
+                else:
+                    channel.scheduled = False
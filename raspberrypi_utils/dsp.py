@@ -0,0 +1,240 @@
+import logging
+from math import sqrt
+
+from utils import LazyModule
+
+numpy = LazyModule('numpy')
+
+
+log = logging.getLogger(__name__)
+
+
+class BaselineTracker(object):
+    # Streaming per axis baseline (mean) and noise (standard deviation) of accelerometer readings, O(1) per sample.
+    # Starts with Welford's algorithm, so the first samples are weighted equally, then switches to an
+    # exponentially weighted moving average (EWMA) once 1/alpha samples have been seen, to follow slow drift.
+    __slots__ = ('alpha', 'k', 'min_threshold', 'min_samples', 'count', 'mean', 'variance')
+
+    def __init__(self, alpha=0.01, k=4.0, min_threshold=0.01, min_samples=10):
+        self.alpha = alpha
+        self.k = k
+        self.min_threshold = min_threshold
+        self.min_samples = min_samples
+        self.count = 0
+        self.mean = [0.0, 0.0, 0.0]
+        self.variance = [0.0, 0.0, 0.0]
+
+    def reset(self):
+        self.count = 0
+        self.mean = [0.0, 0.0, 0.0]
+        self.variance = [0.0, 0.0, 0.0]
+
+    def is_ready(self):
+        return self.count >= self.min_samples
+
+    def update(self, readings):
+        self.count += 1
+        mean = self.mean
+        variance = self.variance
+        if self.count * self.alpha < 1.0:
+            # Welford, variance holds the population variance
+            n = self.count
+            for i in xrange(3):
+                delta = readings[i] - mean[i]
+                mean[i] += delta / n
+                variance[i] += (delta * (readings[i] - mean[i]) - variance[i]) / n
+        else:
+            alpha = self.alpha
+            for i in xrange(3):
+                delta = readings[i] - mean[i]
+                increment = alpha * delta
+                mean[i] += increment
+                variance[i] = (1.0 - alpha) * (variance[i] + delta * increment)
+
+    def update_block(self, block):
+        # Update with a (n, 3) block at once: the block mean and variance are folded in with the combined
+        # weight of n single updates, which approximates updating sample by sample
+        n = len(block)
+        if not n:
+            return
+        if (self.count + n) * self.alpha < 1.0:
+            weight = float(n) / (self.count + n)
+        else:
+            weight = 1.0 - (1.0 - self.alpha) ** n
+        self.count += n
+        block_mean = block.mean(axis=0).tolist()
+        block_variance = block.var(axis=0).tolist()
+        for i in xrange(3):
+            delta = block_mean[i] - self.mean[i]
+            self.mean[i] += weight * delta
+            self.variance[i] = (1.0 - weight) * (self.variance[i] + weight * delta * delta) + weight * block_variance[i]
+
+    def std(self):
+        return [sqrt(v) for v in self.variance]
+
+    def thresholds(self):
+        return [max(self.k * s, self.min_threshold) for s in self.std()]
+
+
+def _lowpass(block, a, state):
+    # First order IIR low-pass y[n] = a * y[n-1] + (1 - a) * x[n] over a (n, 3) block, vectorized with the
+    # closed form y[n] = a^(n+1) * y[-1] + (1 - a) * a^n * sum(a^-k * x[k]). Long blocks are split in segments
+    # short enough for a^-k to stay well within float range. Returns the filtered block and the last output.
+    n = len(block)
+    out = numpy.empty_like(block)
+    segment = n if a >= 0.9999 else max(1, int(-230.0 / numpy.log(a)))  # a^segment >= 1e-100
+    for start in xrange(0, n, segment):
+        x = block[start:start + segment]
+        powers = a ** numpy.arange(len(x), dtype=float)[:, None]
+        out[start:start + segment] = a * powers * state + (1.0 - a) * powers * numpy.cumsum(x / powers, axis=0)
+        state = out[start + len(x) - 1]
+    return out, state
+
+
+class LowPassFilter(object):
+    # First order low-pass filter, keeping its state across blocks
+    def __init__(self, cutoff_hz, sample_rate_hz):
+        self.a = numpy.exp(-2.0 * numpy.pi * cutoff_hz / sample_rate_hz)
+        self.state = None
+
+    def reset(self):
+        self.state = None
+
+    def process(self, block):
+        block = numpy.asarray(block, dtype=float)
+        if not len(block):
+            return block
+        if self.state is None:
+            self.state = block[0].copy()  # start settled on the first sample, rather than ramping up from 0
+        out, self.state = _lowpass(block, self.a, self.state)
+        return out
+
+
+class HighPassFilter(LowPassFilter):
+    # First order high-pass filter (the input minus its low-pass), removes gravity and slow drift
+    def process(self, block):
+        block = numpy.asarray(block, dtype=float)
+        return block - super(HighPassFilter, self).process(block)
+
+
+class Decimator(object):
+    # Low-pass at the new Nyquist frequency, then keep every 'factor'-th sample, in phase across blocks
+    def __init__(self, factor, sample_rate_hz):
+        self.factor = factor
+        self.lowpass = LowPassFilter(sample_rate_hz / (2.0 * factor), sample_rate_hz)
+        self.phase = 0
+
+    def reset(self):
+        self.lowpass.reset()
+        self.phase = 0
+
+    def process(self, block):
+        filtered = self.lowpass.process(block)
+        out = filtered[self.phase::self.factor]
+        self.phase = (self.phase - len(filtered)) % self.factor
+        return out
+
+
+class WindowFeature(object):
+    # Reduce every 'window' samples (non-overlapping) to one row of RMS or peak values per axis
+    # Samples that don't fill a window yet are kept for the next block
+    RMS = 'rms'
+    PEAK = 'peak'
+
+    def __init__(self, window, feature=RMS):
+        if feature not in (self.RMS, self.PEAK):
+            raise ValueError('Unknown window feature {}'.format(feature))
+        self.window = window
+        self.feature = feature
+        self.pending = numpy.empty((0, 3))
+
+    def reset(self):
+        self.pending = numpy.empty((0, 3))
+
+    def process(self, block):
+        block = numpy.concatenate((self.pending, numpy.asarray(block, dtype=float)))
+        count = len(block) // self.window
+        self.pending = block[count * self.window:]
+        windows = block[:count * self.window].reshape(count, self.window, 3)
+        if self.feature == self.RMS:
+            return numpy.sqrt(numpy.mean(windows * windows, axis=1))
+        return numpy.abs(windows).max(axis=1)
+
+
+class FilterPipeline(object):
+    # Chain of filter stages, each taking and returning (n, 3) blocks
+    def __init__(self, *stages):
+        self.stages = stages
+
+    def reset(self):
+        for stage in self.stages:
+            stage.reset()
+
+    def process(self, block):
+        for stage in self.stages:
+            block = stage.process(block)
+        return block
+
+
+class SpectrumAnalyzer(object):
+    # Incremental Welch-style spectrum: Hann windowed FFTs over overlapping windows of the incoming blocks,
+    # summed over the three axis and averaged across windows with an EWMA, reported as energy per frequency band.
+    # The window buffer, the Hann window and the band slices are computed once and reused for every window.
+    def __init__(self, sample_rate_hz, bands, window=256, overlap=0.5, averaging=0.25):
+        if not 0 <= overlap < 1:
+            raise ValueError('Overlap must be in [0, 1)')
+        self.sample_rate_hz = float(sample_rate_hz)
+        self.bands = list(bands)
+        self.window = window
+        self.step = max(1, int(window * (1.0 - overlap)))
+        self.averaging = averaging
+        self.hann = numpy.hanning(window)[:, None]
+        self.scale = 1.0 / (self.sample_rate_hz * numpy.sum(self.hann ** 2))  # power spectral density, in g^2/Hz
+        self.frequencies = numpy.fft.rfftfreq(window, 1.0 / self.sample_rate_hz)
+        self.resolution = self.sample_rate_hz / window
+        self.band_slices = [
+            slice(numpy.searchsorted(self.frequencies, low), numpy.searchsorted(self.frequencies, high, side='right'))
+            for low, high in self.bands
+        ]
+        self.buffer = numpy.zeros((window, 3))
+        self.work = numpy.empty((window, 3))
+        self.filled = 0
+        self.psd = None
+
+    def reset(self):
+        self.filled = 0
+        self.psd = None
+
+    def band_energy(self):
+        # latest averaged energy per band, in g^2, or None before the first window
+        if self.psd is None:
+            return None
+        return numpy.array([self.psd[s].sum() * self.resolution for s in self.band_slices])
+
+    def process(self, block):
+        # returns a list with the band energies after each window completed by this block
+        energies = []
+        block = numpy.asarray(block, dtype=float)
+        while len(block):
+            n = min(self.window - self.filled, len(block))
+            self.buffer[self.filled:self.filled + n] = block[:n]
+            self.filled += n
+            block = block[n:]
+            if self.filled == self.window:
+                self._update()
+                energies.append(self.band_energy())
+                # keep the overlapping tail for the next window
+                self.buffer[:self.window - self.step] = self.buffer[self.step:]
+                self.filled = self.window - self.step
+        return energies
+
+    def _update(self):
+        numpy.subtract(self.buffer, self.buffer.mean(axis=0), out=self.work)  # remove gravity / DC
+        numpy.multiply(self.work, self.hann, out=self.work)
+        spectrum = numpy.fft.rfft(self.work, axis=0)
+        psd = (spectrum.real ** 2 + spectrum.imag ** 2).sum(axis=1) * self.scale
+        psd[1:-1] *= 2  # one-sided
+        if self.psd is None:
+            self.psd = psd
+        else:
+            self.psd += self.averaging * (psd - self.psd)
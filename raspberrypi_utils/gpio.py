@@ -0,0 +1,520 @@
+from collections import deque
+import importlib
+import logging
+import os
+import select
+from threading import Condition, Lock, Thread, Timer
+from time import sleep, time
+
+from utils import monotonic
+
+
+log = logging.getLogger(__name__)
+
+
+class _Constants(object):
+    # the values of RPi.GPIO, so they can be passed straight through to it
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    HIGH = 1
+    LOW = 0
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+
+def _matches(edge, level):
+    return edge == _Constants.BOTH or (edge == _Constants.RISING) == bool(level)
+
+
+def _wait_for_level(backend, pin, edge, timeout):
+    # wait_for_edge_timestamp() for backends without edge timestamps: the edge is timed when it's seen
+    if backend.input(pin) == (backend.HIGH if edge == backend.RISING else backend.LOW):
+        return monotonic()
+    kwargs = {} if timeout is None else {'timeout': timeout}
+    if backend.wait_for_edge(pin, edge, **kwargs) is None:
+        return None
+    return monotonic()
+
+
+class RPiGPIOBackend(_Constants):
+    # RPi.GPIO, plus add_event_batch_detect() on top of its edge callbacks (one event per batch, timestamped
+    # when the callback runs, the level is read after the edge), and wait_for_edge_timestamp() timing the edge
+    # (in monotonic() seconds) when wait_for_edge returns
+    def __init__(self):
+        self.module = importlib.import_module('RPi.GPIO')
+
+    def __getattr__(self, name):
+        return getattr(self.module, name)
+
+    def wait_for_edge_timestamp(self, pin, edge, timeout=None):
+        return _wait_for_level(self, pin, edge, timeout)
+
+    def add_event_batch_detect(self, pin, edge, callback, bouncetime=None):
+        def edge_callback(channel):
+            callback([(channel, None if edge == self.BOTH else int(edge == self.RISING), time())])
+
+        if bouncetime is None:
+            self.module.add_event_detect(pin, edge, callback=edge_callback)
+        else:
+            self.module.add_event_detect(pin, edge, callback=edge_callback, bouncetime=bouncetime)
+
+
+class _Watch(object):
+    __slots__ = ('edge', 'callbacks', 'bouncetime', 'last')
+
+    def __init__(self, edge, bouncetime):
+        self.edge = edge
+        self.callbacks = []  # (batched, callback)
+        self.bouncetime = (bouncetime or 0) / 1000.0
+        self.last = None
+
+
+class _SoftPWM(object):
+    # software PWM on a thread, with the RPi.GPIO PWM interface
+    def __init__(self, backend, pin, frequency):
+        self.backend = backend
+        self.pin = pin
+        self.frequency = float(frequency)
+        self.duty_cycle = 0.0
+        self.running = False
+        self.thread = None
+
+    def start(self, duty_cycle):
+        self.duty_cycle = float(duty_cycle)
+        if not self.running:
+            self.running = True
+            self.thread = Thread(target=self._run, name='SoftPWM-{}'.format(self.pin))
+            self.thread.daemon = True
+            self.thread.start()
+
+    def ChangeDutyCycle(self, duty_cycle):
+        self.duty_cycle = float(duty_cycle)
+
+    def ChangeFrequency(self, frequency):
+        self.frequency = float(frequency)
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.backend.output(self.pin, self.backend.LOW)
+
+    def _run(self):
+        while self.running:
+            period = 1.0 / self.frequency
+            on = period * self.duty_cycle / 100.0
+            if on > 0:
+                self.backend.output(self.pin, self.backend.HIGH)
+                sleep(on)
+            if on < period:
+                self.backend.output(self.pin, self.backend.LOW)
+                sleep(period - on)
+
+
+class GpiodBackend(_Constants):
+    # GPIO character device (/dev/gpiochipN) through the libgpiod bindings, BCM numbering only.
+    # Inputs are requested with edge events, which the kernel timestamps and queues when the edge happens, so edges
+    # are neither missed nor timed late when the system is busy. One thread waits on all the lines and delivers
+    # every line's queued events at once: add_event_batch_detect() callbacks get them as a list of
+    # (pin, level, timestamp), timestamps in time() seconds; add_event_detect() callbacks are called per event.
+    CONSUMER = 'raspberrypi_utils'
+
+    def __init__(self, chip='gpiochip0'):
+        self.gpiod = importlib.import_module('gpiod')
+        self.chip = self.gpiod.Chip(chip)
+        self.lock = Lock()
+        self.lines = {}  # pin: (line, direction, pull_up_down)
+        self.watches = {}
+        self.pwms = {}
+        self.thread = None
+        self.wakeup = None
+
+    def setmode(self, mode):
+        if mode != self.BCM:
+            raise ValueError('GpiodBackend only supports BCM pin numbering')
+
+    def getmode(self):
+        return self.BCM
+
+    def setwarnings(self, enabled):
+        pass
+
+    def _flags(self, pull_up_down):
+        name = {
+            self.PUD_UP: 'LINE_REQ_FLAG_BIAS_PULL_UP',
+            self.PUD_DOWN: 'LINE_REQ_FLAG_BIAS_PULL_DOWN',
+            self.PUD_OFF: 'LINE_REQ_FLAG_BIAS_DISABLE',
+        }.get(pull_up_down)
+        return getattr(self.gpiod, name, 0) if name else 0  # bias needs libgpiod 1.5
+
+    def setup(self, pin, direction, pull_up_down=_Constants.PUD_OFF, initial=None):
+        with self.lock:
+            current = self.lines.get(pin)
+            if current is not None:
+                if current[1:] == (direction, pull_up_down):
+                    if direction == self.OUT and initial is not None:
+                        current[0].set_value(int(initial))
+                    return
+                if pin in self.watches:
+                    raise RuntimeError('Edge detection is active on GPIO {}'.format(pin))
+                current[0].release()
+            line = self.chip.get_line(pin)
+            if direction == self.OUT:
+                line.request(consumer=self.CONSUMER, type=self.gpiod.LINE_REQ_DIR_OUT, default_val=initial or 0)
+            else:
+                line.request(consumer=self.CONSUMER, type=self.gpiod.LINE_REQ_EV_BOTH_EDGES,
+                             flags=self._flags(pull_up_down))
+            self.lines[pin] = (line, direction, pull_up_down)
+
+    def _line(self, pin):
+        try:
+            return self.lines[pin][0]
+        except KeyError:
+            raise RuntimeError('GPIO {} has not been set up'.format(pin))
+
+    def input(self, pin):
+        return self._line(pin).get_value()
+
+    def output(self, pins, values):
+        if isinstance(pins, (list, tuple)):
+            if not isinstance(values, (list, tuple)):
+                values = [values] * len(pins)
+            for pin, value in zip(pins, values):
+                self._line(pin).set_value(int(value))
+        else:
+            self._line(pins).set_value(int(values))
+
+    def _timestamp(self, event, now, now_monotonic, monotonic_clock):
+        # kernels before 5.7 timestamp events with CLOCK_REALTIME, later ones with CLOCK_MONOTONIC; returns the
+        # timestamp in time() seconds, or in monotonic() seconds with monotonic_clock
+        timestamp = event.sec + event.nsec * 1e-9
+        if abs(timestamp - now) < abs(timestamp - now_monotonic):
+            return now_monotonic - (now - timestamp) if monotonic_clock else timestamp
+        return timestamp if monotonic_clock else now - (now_monotonic - timestamp)
+
+    def _read_events(self, pin, line, monotonic_clock=False):
+        now, now_monotonic = time(), monotonic()
+        rising = self.gpiod.LineEvent.RISING_EDGE
+        return [
+            (pin, int(event.type == rising), self._timestamp(event, now, now_monotonic, monotonic_clock))
+            for event in line.event_read_multiple()
+        ]
+
+    def _watch(self, pin, edge, bouncetime, batched, callback):
+        line = self._line(pin)
+        with self.lock:
+            watch = self.watches.get(pin)
+            if watch is None:
+                watch = self.watches[pin] = _Watch(edge, bouncetime)
+                while line.event_wait(sec=0):  # only edges from now on
+                    line.event_read_multiple()
+            elif watch.edge != edge:
+                raise RuntimeError('Conflicting edge detection already enabled for GPIO {}'.format(pin))
+            watch.callbacks.append((batched, callback))
+            if self.thread is None:
+                self.wakeup = os.pipe()
+                self.thread = Thread(target=self._run, name='GpiodBackend')
+                self.thread.daemon = True
+                self.thread.start()
+        os.write(self.wakeup[1], b'w')
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        self._watch(pin, edge, bouncetime, False, callback)
+
+    def add_event_callback(self, pin, callback):
+        with self.lock:
+            self.watches[pin].callbacks.append((False, callback))
+
+    def add_event_batch_detect(self, pin, edge, callback, bouncetime=None):
+        self._watch(pin, edge, bouncetime, True, callback)
+
+    def remove_event_detect(self, pin):
+        with self.lock:
+            self.watches.pop(pin, None)
+        if self.wakeup is not None:
+            os.write(self.wakeup[1], b'w')
+
+    def _wait_for_event(self, pin, edge, timeout, flush):
+        line = self._line(pin)
+        if pin in self.watches:
+            raise RuntimeError('Conflicting edge detection already enabled for GPIO {}'.format(pin))
+        while flush and line.event_wait(sec=0):
+            line.event_read_multiple()
+        deadline = None if timeout is None else time() + timeout / 1000.0
+        while True:
+            remaining = 3600.0 if deadline is None else deadline - time()
+            if remaining <= 0 or not line.event_wait(sec=int(remaining), nsec=int(remaining % 1 * 1e9)):
+                return None
+            for event in self._read_events(pin, line, monotonic_clock=True):
+                if _matches(edge, event[1]):
+                    return event
+
+    def wait_for_edge(self, pin, edge, timeout=None, bouncetime=None):
+        return None if self._wait_for_event(pin, edge, timeout, True) is None else pin
+
+    def wait_for_edge_timestamp(self, pin, edge, timeout=None):
+        # kernel timestamp (in monotonic() seconds) of the first matching edge since the pin was set up as an input,
+        # waiting up to timeout milliseconds for it, None if there was none
+        event = self._wait_for_event(pin, edge, timeout, False)
+        return None if event is None else event[2]
+
+    def PWM(self, pin, frequency):
+        pwm = self.pwms[pin] = _SoftPWM(self, pin, frequency)
+        return pwm
+
+    def cleanup(self, pins=None):
+        with self.lock:
+            pins = list(self.lines) if pins is None else pins if isinstance(pins, (list, tuple)) else [pins]
+            for pin in pins:
+                self.watches.pop(pin, None)
+                pwm = self.pwms.pop(pin, None)
+                if pwm is not None:
+                    pwm.running = False
+                entry = self.lines.pop(pin, None)
+                if entry is not None:
+                    entry[0].release()
+        if self.wakeup is not None:
+            os.write(self.wakeup[1], b'w')
+
+    def _run(self):
+        while True:
+            with self.lock:
+                watched = dict((self.lines[pin][0].event_get_fd(), pin) for pin in self.watches)
+            readable, _, _ = select.select(list(watched) + [self.wakeup[0]], [], [])
+            for fd in readable:
+                if fd == self.wakeup[0]:
+                    os.read(fd, 64)
+                    continue
+                pin = watched[fd]
+                with self.lock:
+                    watch = self.watches.get(pin)
+                    entry = self.lines.get(pin)
+                if watch is None or entry is None:
+                    continue
+                events = []
+                for event in self._read_events(pin, entry[0]):
+                    if not _matches(watch.edge, event[1]):
+                        continue
+                    if watch.last is not None and event[2] - watch.last < watch.bouncetime:
+                        continue
+                    watch.last = event[2]
+                    events.append(event)
+                if events:
+                    self._deliver(watch, events)
+
+    def _deliver(self, watch, events):
+        for batched, callback in list(watch.callbacks):
+            try:
+                if batched:
+                    callback(events)
+                else:
+                    for event in events:
+                        callback(event[0])
+            except Exception:
+                log.exception('GpiodBackend: error in edge callback')
+
+
+class _FakePWM(object):
+    def __init__(self, backend, pin, frequency):
+        self.backend = backend
+        self.pin = pin
+        self.frequency = frequency
+        self.duty_cycle = None  # None while stopped
+
+    def start(self, duty_cycle):
+        self.duty_cycle = duty_cycle
+
+    def ChangeDutyCycle(self, duty_cycle):
+        self.duty_cycle = duty_cycle
+
+    def ChangeFrequency(self, frequency):
+        self.frequency = frequency
+
+    def stop(self):
+        self.duty_cycle = None
+
+
+class FakeGPIO(_Constants):
+    # In-memory GPIO for tests and benchmarks. Inputs are driven with set_input() or pulse(), which run the edge
+    # callbacks synchronously; every output change is recorded in history as (time, pin, level).
+    # set_charge_time() simulates an RC circuit (see input_devices.LightSensor): the input goes high that many
+    # seconds after the pin is set up as an input.
+    def __init__(self, history_size=1000):
+        self.mode = None
+        self.condition = Condition()
+        self.directions = {}
+        self.levels = {}
+        self.charge_times = {}
+        self.watches = {}
+        self.pwms = {}
+        self.history = deque(maxlen=history_size)
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def getmode(self):
+        return self.mode
+
+    def setwarnings(self, enabled):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=_Constants.PUD_OFF, initial=None):
+        with self.condition:
+            self.directions[pin] = direction
+            if direction == self.OUT:
+                self._write(pin, initial or self.LOW)
+            elif pin in self.charge_times:
+                timer = Timer(self.charge_times[pin], self.set_input, (pin, self.HIGH))
+                timer.daemon = True
+                timer.start()
+            elif pin not in self.levels:
+                self.levels[pin] = self.HIGH if pull_up_down == self.PUD_UP else self.LOW
+
+    def input(self, pin):
+        return self.levels.get(pin, self.LOW)
+
+    def _write(self, pin, level):
+        self.levels[pin] = int(level)
+        self.history.append((time(), pin, int(level)))
+
+    def output(self, pins, values):
+        with self.condition:
+            if isinstance(pins, (list, tuple)):
+                if not isinstance(values, (list, tuple)):
+                    values = [values] * len(pins)
+                for pin, value in zip(pins, values):
+                    self._write(pin, value)
+            else:
+                self._write(pins, values)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        with self.condition:
+            self.watches.setdefault(pin, (edge, []))[1].append((False, callback))
+
+    def add_event_callback(self, pin, callback):
+        with self.condition:
+            self.watches[pin][1].append((False, callback))
+
+    def add_event_batch_detect(self, pin, edge, callback, bouncetime=None):
+        with self.condition:
+            self.watches.setdefault(pin, (edge, []))[1].append((True, callback))
+
+    def remove_event_detect(self, pin):
+        with self.condition:
+            self.watches.pop(pin, None)
+
+    def wait_for_edge(self, pin, edge, timeout=None, bouncetime=None):
+        deadline = None if timeout is None else time() + timeout / 1000.0
+        with self.condition:
+            level = self.input(pin)
+            while True:
+                remaining = None if deadline is None else deadline - time()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+                new_level = self.input(pin)
+                if new_level != level and _matches(edge, new_level):
+                    return pin
+                level = new_level
+
+    def wait_for_edge_timestamp(self, pin, edge, timeout=None):
+        return _wait_for_level(self, pin, edge, timeout)
+
+    def set_input(self, pin, level, timestamp=None):
+        with self.condition:
+            level = int(level)
+            if self.levels.get(pin, self.LOW) == level:
+                return
+            self.levels[pin] = level
+            self.condition.notify_all()
+            edge, callbacks = self.watches.get(pin, (None, ()))
+            callbacks = list(callbacks)
+        if edge is None or not _matches(edge, level):
+            return
+        event = (pin, level, time() if timestamp is None else timestamp)
+        for batched, callback in callbacks:
+            if batched:
+                callback([event])
+            elif callback is not None:
+                callback(pin)
+
+    def set_charge_time(self, pin, seconds):
+        self.charge_times[pin] = seconds
+
+    def pulse(self, pin):
+        self.set_input(pin, self.HIGH)
+        self.set_input(pin, self.LOW)
+
+    def PWM(self, pin, frequency):
+        pwm = self.pwms[pin] = _FakePWM(self, pin, frequency)
+        return pwm
+
+    def cleanup(self, pins=None):
+        with self.condition:
+            pins = list(self.directions) if pins is None else pins if isinstance(pins, (list, tuple)) else [pins]
+            for pin in pins:
+                self.directions.pop(pin, None)
+                self.watches.pop(pin, None)
+                self.pwms.pop(pin, None)
+
+
+BACKENDS = {
+    'rpi': RPiGPIOBackend,
+    'gpiod': GpiodBackend,
+    'fake': FakeGPIO,
+}
+
+
+class _LazyGPIO(_Constants):
+    # Stands in for the RPi.GPIO module: the constants are available right away, the backend is only created when
+    # a function is first used, so importing the devices doesn't need a Raspberry Pi. The backend is the one given
+    # to use(), else the RASPBERRYPI_UTILS_GPIO environment variable ('rpi', 'gpiod' or 'fake'), else RPi.GPIO if
+    # it can be imported, else gpiod. Functions are looked up once, then cached on this object.
+    def __init__(self):
+        self.__dict__['_lock'] = Lock()
+        self.__dict__['backend'] = None
+
+    def use(self, backend):
+        # backend name or instance, to be called before the first GPIO function
+        if isinstance(backend, basestring):
+            if backend not in BACKENDS:
+                raise ValueError('Unknown GPIO backend {}'.format(backend))
+            backend = BACKENDS[backend]()
+        with self._lock:
+            for name in list(self.__dict__):
+                if name not in ('_lock', 'backend'):
+                    del self.__dict__[name]
+            self.__dict__['backend'] = backend
+        log.debug('GPIO backend: {}'.format(type(backend).__name__))
+        return backend
+
+    def get_backend(self):
+        backend = self.backend
+        if backend is None:
+            name = os.environ.get('RASPBERRYPI_UTILS_GPIO')
+            if name:
+                return self.use(name)
+            try:
+                return self.use('rpi')
+            except (ImportError, RuntimeError) as e:
+                log.debug('RPi.GPIO not available ({}), using gpiod'.format(e))
+                return self.use('gpiod')
+        return backend
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        value = getattr(self.get_backend(), name)
+        if callable(value):
+            self.__dict__[name] = value
+        return value
+
+
+GPIO = _LazyGPIO()
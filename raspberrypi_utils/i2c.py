@@ -0,0 +1,476 @@
+from abc import ABCMeta, abstractmethod
+import ctypes
+import fcntl
+import logging
+import os
+import random
+import struct
+from threading import Event, RLock, Thread
+from time import time
+
+from runtime import DeviceRuntime
+from utils import LazyModule
+
+I2C = LazyModule('Adafruit_GPIO.I2C')
+
+
+log = logging.getLogger(__name__)
+
+
+class I2CTransport(object):
+    __metaclass__ = ABCMeta
+    # Interface of an I2C device, as used by the drivers (the same methods as Adafruit_GPIO.I2C.Device).
+    # max_block_bytes is the largest readList() the transport can do in a single transaction.
+    max_block_bytes = 32
+
+    def readU8(self, register):
+        return self.readList(register, 1)[0]
+
+    def write8(self, register, value):
+        self.writeList(register, [value])
+
+    @abstractmethod
+    def readList(self, register, length):
+        pass
+
+    @abstractmethod
+    def writeList(self, register, data):
+        pass
+
+
+class SMBusTransport(I2CTransport):
+    # Adafruit_GPIO's SMBus based device, block reads are limited to 32 bytes by SMBus
+    def __init__(self, address, bus=-1):
+        self.device = I2C.Device(address, busnum=bus)
+
+    def readU8(self, register):
+        return self.device.readU8(register)
+
+    def write8(self, register, value):
+        self.device.write8(register, value)
+
+    def readList(self, register, length):
+        return self.device.readList(register, length)
+
+    def writeList(self, register, data):
+        self.device.writeList(register, data)
+
+
+class _i2c_msg(ctypes.Structure):
+    _fields_ = [
+        ('addr', ctypes.c_uint16),
+        ('flags', ctypes.c_uint16),
+        ('len', ctypes.c_uint16),
+        ('buf', ctypes.POINTER(ctypes.c_uint8)),
+    ]
+
+
+class _i2c_rdwr_ioctl_data(ctypes.Structure):
+    _fields_ = [
+        ('msgs', ctypes.POINTER(_i2c_msg)),
+        ('nmsgs', ctypes.c_uint32),
+    ]
+
+
+class LinuxI2CTransport(I2CTransport):
+    # Direct /dev/i2c-N access with I2C_RDWR combined transactions: writing the register address and reading the
+    # whole block (e.g. a full LIS3DH FIFO) is a single ioctl, with a repeated start instead of a stop in between
+    I2C_RDWR = 0x0707
+    I2C_M_RD = 0x0001
+    max_block_bytes = 4096
+
+    def __init__(self, address, bus=-1):
+        self.address = address
+        self.bus = 1 if bus < 0 else bus
+        self.fd = os.open('/dev/i2c-{}'.format(self.bus), os.O_RDWR)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _transfer(self, *msgs):
+        messages = (_i2c_msg * len(msgs))(*msgs)
+        fcntl.ioctl(self.fd, self.I2C_RDWR, _i2c_rdwr_ioctl_data(messages, len(msgs)))
+
+    def _msg(self, flags, buf):
+        return _i2c_msg(self.address, flags, len(buf), ctypes.cast(buf, ctypes.POINTER(ctypes.c_uint8)))
+
+    def readList(self, register, length):
+        out = (ctypes.c_uint8 * 1)(register)
+        buf = (ctypes.c_uint8 * length)()
+        self._transfer(self._msg(0, out), self._msg(self.I2C_M_RD, buf))
+        return bytearray(buf)
+
+    def writeList(self, register, data):
+        out = (ctypes.c_uint8 * (len(data) + 1))(register, *data)
+        self._transfer(self._msg(0, out))
+
+
+class InstrumentedTransport(object):
+    # Reports every transaction of a device to a metrics.MetricsRegistry: count, bytes, errors and duration, by bus
+    # and address. Only put in place while metrics are enabled (see LIS3DH), so it costs nothing otherwise.
+    def __init__(self, device, registry, bus, address):
+        self.device = device
+        self.max_block_bytes = getattr(device, 'max_block_bytes', I2CTransport.max_block_bytes)
+        labels = dict(bus=bus, address='0x{:02X}'.format(address))
+        self.transactions = registry.counter('i2c_transactions_total', 'I2C transactions', **labels)
+        self.read_bytes = registry.counter('i2c_read_bytes_total', 'Bytes read over I2C', **labels)
+        self.written_bytes = registry.counter('i2c_written_bytes_total', 'Bytes written over I2C', **labels)
+        self.errors = registry.counter('i2c_errors_total', 'Failed I2C transactions', **labels)
+        self.duration = registry.histogram('i2c_transaction_seconds', 'I2C transaction duration', **labels)
+
+    def _call(self, method, *args):
+        start = time()
+        try:
+            return method(*args)
+        except IOError:
+            self.errors.inc()
+            raise
+        finally:
+            self.duration.observe(time() - start)
+            self.transactions.inc()
+
+    def readU8(self, register):
+        self.read_bytes.inc()
+        return self._call(self.device.readU8, register)
+
+    def write8(self, register, value):
+        self.written_bytes.inc()
+        self._call(self.device.write8, register, value)
+
+    def readList(self, register, length):
+        self.read_bytes.inc(length)
+        return self._call(self.device.readList, register, length)
+
+    def writeList(self, register, data):
+        self.written_bytes.inc(len(data))
+        self._call(self.device.writeList, register, data)
+
+
+class LockedDevice(object):
+    # I2C device whose transactions are serialized with those of every other device on the same bus
+    def __init__(self, device, lock):
+        self.device = device
+        self.lock = lock
+        self.max_block_bytes = getattr(device, 'max_block_bytes', I2CTransport.max_block_bytes)
+
+    def readU8(self, register):
+        with self.lock:
+            return self.device.readU8(register)
+
+    def write8(self, register, value):
+        with self.lock:
+            self.device.write8(register, value)
+
+    def readList(self, register, length):
+        with self.lock:
+            return self.device.readList(register, length)
+
+    def writeList(self, register, data):
+        with self.lock:
+            self.device.writeList(register, data)
+
+
+def resolve_bus(bus):
+    # -1 stands for the board's default bus, as for Adafruit_GPIO (1 as in LinuxI2CTransport if Adafruit_GPIO isn't
+    # installed or doesn't know the board)
+    if bus >= 0:
+        return bus
+    try:
+        return I2C.get_default_bus()
+    except (ImportError, RuntimeError):
+        return 1
+
+
+class I2CBusManager(object):
+    # Owns the I2C device handles, with one lock per bus so that devices (and threads) sharing a bus never interleave
+    # transactions. Sensors registered with a callback are all sampled in one sweep every sweep_seconds, on a
+    # DeviceRuntime (a private one unless given), instead of each polling on its own thread.
+    # transport_factory(address, bus) creates the device handles, SMBusTransport by default.
+    def __init__(self, sweep_seconds=1.0, runtime=None, transport_factory=SMBusTransport):
+        self.sweep_seconds = sweep_seconds
+        self.transport_factory = transport_factory
+        self.own_runtime = runtime is None
+        self.runtime = DeviceRuntime(name='I2CBusManager') if runtime is None else runtime
+        self.locks = {}
+        self.devices = {}
+        self.sensors = []
+        self.sweep_job = None
+
+    def lock(self, bus):
+        bus = resolve_bus(bus)
+        lock = self.locks.get(bus)
+        if lock is None:
+            lock = self.locks.setdefault(bus, RLock())
+        return lock
+
+    def get_device(self, address, bus):
+        # keyed on the resolved bus, so that bus=-1 and its number share one handle and one lock
+        bus = resolve_bus(bus)
+        key = (bus, address)
+        device = self.devices.get(key)
+        if device is None:
+            device = LockedDevice(self.transport_factory(address, bus), self.lock(bus))
+            self.devices[key] = device
+        return device
+
+    def register(self, sensor, callback, frequency_seconds=None):
+        # callback(sensor.get_xyz()) on every sweep; sensors are read grouped by bus
+        # frequency_seconds: how often the sensor's owner expects readings, the sweeps are what it gets
+        if frequency_seconds is not None and frequency_seconds != self.sweep_seconds:
+            log.warning('I2CBusManager: 0x{:X} on bus {} is read every {}s sweep, not every {}s'.format(
+                sensor.address, sensor.bus, self.sweep_seconds, frequency_seconds))
+        self.sensors.append((sensor, callback))
+        self.sensors.sort(key=lambda entry: resolve_bus(entry[0].bus))
+        if self.sweep_job is None:
+            self.sweep_job = self.runtime.schedule_periodic(self.sweep_seconds, self.sweep)
+            if self.own_runtime:
+                self.runtime.start()
+
+    def unregister(self, sensor):
+        self.sensors = [(s, c) for s, c in self.sensors if s is not sensor]
+
+    def sweep(self):
+        for sensor, callback in list(self.sensors):
+            try:
+                readings = sensor.get_xyz()
+            except IOError as e:
+                log.warning('I2C read from 0x{:X} on bus {} failed: {}'.format(sensor.address, sensor.bus, e))
+                continue
+            callback(readings)
+
+    def stop(self):
+        if self.sweep_job is not None:
+            self.sweep_job.cancel()
+            self.sweep_job = None
+        if self.own_runtime:
+            self.runtime.stop()
+
+
+class SimulatedLIS3DH(I2CTransport):
+    # In-memory model of the LIS3DH register map, to exercise and benchmark the driver without hardware.
+    # Samples are generated at the configured output data rate from signal(t), which returns (x, y, z) in g
+    # (1g on z plus noise by default), following the data sheet for: auto-increment (register MSB), output
+    # registers wrapping around while the FIFO is enabled, bypass / FIFO / stream modes with watermark and overrun,
+    # and INT1 (data ready, FIFO watermark and latched high-event motion interrupts, optionally high-pass filtered).
+    # INT1 rising edges call the functions in int1_callbacks (outside of the model's lock, so they may read the
+    # sensor); start() ticks the model on a thread so edges happen without bus traffic, one lock serializes the
+    # ticks and the transactions. Transactions, bytes and samples read are counted.
+    max_block_bytes = 4096
+    FIFO_SIZE = 32
+    ODR_HZ = {1: 1, 2: 10, 3: 25, 4: 50, 5: 100, 6: 200, 7: 400, 8: 1600, 9: 1344}
+    COUNTS_PER_G = {0: 16380, 1: 8190, 2: 4096, 3: 1365.33}
+    THRESHOLD_LSB = {0: 0.016, 1: 0.032, 2: 0.062, 3: 0.186}
+
+    def __init__(self, address=0x18, bus=1, signal=None, noise_g=0.002, clock=time):
+        self.address = address
+        self.bus = bus
+        self.signal = signal or (lambda t: (0.0, 0.0, 1.0))
+        self.noise_g = noise_g
+        self.clock = clock
+        self.registers = bytearray(0x40)
+        self.registers[0x0F] = 0x33  # WHOAMI
+        self.registers[0x20] = 0x07  # CTRL1 power on default, all axis enabled, powered down
+        self.output = [0, 0, 0]  # latest raw sample, in bypass mode
+        self.fifo = []
+        self.fifo_overrun = False
+        self.data_ready = False
+        self.int1_active = False  # latched motion event
+        self.int1_source = 0
+        self.motion_samples = 0
+        self.baseline = [0.0, 0.0, 0.0]  # high-pass filter reference
+        self.int1_level = False
+        self.int1_callbacks = []
+        self.last_sample = clock()
+        self.transactions = 0
+        self.samples_read = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.lock = RLock()
+        self.stop_event = Event()
+        self.thread = None
+
+    def start(self, tick_seconds=0.001):
+        self.stop_event.clear()
+        self.thread = Thread(target=self._run, args=(tick_seconds,), name='SimulatedLIS3DH')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self, tick_seconds):
+        while not self.stop_event.wait(tick_seconds):
+            self.tick()
+
+    def fifo_enabled(self):
+        return bool(self.registers[0x24] & 0x40) and self.registers[0x2E] >> 6 != 0
+
+    def odr_hz(self):
+        return self.ODR_HZ.get(self.registers[0x20] >> 4, 0)
+
+    def tick(self):
+        # generate the samples due since the last one, then update INT1
+        with self.lock:
+            self._generate()
+            rising = self._update_int1()
+        self._int1_edge(rising)
+
+    def _generate(self):
+        odr = self.odr_hz()
+        now = self.clock()
+        if not odr:
+            self.last_sample = now
+        else:
+            count = int((now - self.last_sample) * odr)
+            if count:
+                skipped = max(0, count - self.FIFO_SIZE - 1)  # older samples would be overwritten anyway
+                for i in xrange(skipped, count):
+                    self._sample(self.last_sample + (i + 1) / float(odr))
+                self.last_sample += count / float(odr)
+                if skipped and self.fifo_enabled():
+                    self.fifo_overrun = True
+
+    def _sample(self, t):
+        counts_per_g = self.COUNTS_PER_G[(self.registers[0x23] >> 4) & 0b11]
+        values = [v + random.gauss(0, self.noise_g) if self.noise_g else v for v in self.signal(t)]
+        raw = [max(-32768, min(32767, int(round(v * counts_per_g)))) & 0xFFF0 for v in values]
+        raw = [r - 0x10000 if r & 0x8000 else r for r in raw]
+        self.output = raw
+        self.data_ready = True
+        if self.fifo_enabled():
+            mode = self.registers[0x2E] >> 6
+            if len(self.fifo) >= self.FIFO_SIZE:
+                if mode == 0b10:  # stream, drop the oldest
+                    self.fifo.pop(0)
+                    self.fifo.append(raw)
+            else:
+                self.fifo.append(raw)
+            if len(self.fifo) == self.FIFO_SIZE:
+                self.fifo_overrun = True  # OVRN_FIFO is set as soon as the FIFO is full, with the 32nd sample
+        self._motion(values)
+
+    def _motion(self, values):
+        cfg = self.registers[0x30]
+        if not cfg & 0x2A:
+            return
+        if self.registers[0x21] & 0x01:  # HP_IA1, compare against a slowly following reference
+            filtered = []
+            for i in xrange(3):
+                self.baseline[i] += 0.05 * (values[i] - self.baseline[i])
+                filtered.append(values[i] - self.baseline[i])
+            values = filtered
+        threshold = self.registers[0x32] * self.THRESHOLD_LSB[(self.registers[0x23] >> 4) & 0b11]
+        source = 0
+        for i in xrange(3):
+            if cfg & (0x02 << (2 * i)) and abs(values[i]) > threshold:
+                source |= 0x02 << (2 * i)
+        if source:
+            self.motion_samples += 1
+            if self.motion_samples > self.registers[0x33]:
+                self.int1_active = True
+                self.int1_source = 0x40 | source
+        else:
+            self.motion_samples = 0
+            if not self.registers[0x24] & 0x08:  # not latched
+                self.int1_active = False
+
+    def _update_int1(self):
+        ctrl3 = self.registers[0x22]
+        level = bool(
+            (ctrl3 & 0x10 and self.data_ready) or
+            (ctrl3 & 0x04 and self.fifo_enabled() and len(self.fifo) > (self.registers[0x2E] & 0x1F)) or
+            (ctrl3 & 0x40 and self.int1_active)
+        )
+        rising = level and not self.int1_level
+        self.int1_level = level
+        return rising
+
+    def _int1_edge(self, rising):
+        if rising:
+            for callback in self.int1_callbacks:
+                callback(self)
+
+    def _read(self, register):
+        if register == 0x27:  # STATUS2
+            return 0x08 if self.data_ready else 0
+        if register == 0x2F:  # FIFOSRC
+            level = len(self.fifo)
+            val = min(level, 31)
+            if level > (self.registers[0x2E] & 0x1F):
+                val |= 0x80
+            if self.fifo_overrun:
+                val |= 0x40
+            if not level:
+                val |= 0x20
+            return val
+        if register == 0x31:  # INT1SRC, reading clears the latched interrupt
+            val = self.int1_source if self.int1_active else 0
+            self.int1_active = False
+            self.int1_source = 0
+            return val
+        if register == 0x26:  # REFERENCE, reading resets the high-pass filter
+            self.baseline = [0.0, 0.0, 0.0]
+        return self.registers[register]
+
+    def readList(self, register, length):
+        with self.lock:
+            data = self._read_list(register, length)
+            rising = self._update_int1()
+        self._int1_edge(rising)
+        return data
+
+    def _read_list(self, register, length):
+        self.transactions += 1
+        self.bytes_read += length
+        self._generate()
+        increment = bool(register & 0x80)
+        register &= 0x7F
+        fifo = self.fifo_enabled()
+        data = bytearray()
+        sample = None
+        for i in xrange(length):
+            if 0x28 <= register <= 0x2D:
+                if sample is None:
+                    sample = struct.pack('<hhh', *(self.fifo[0] if fifo and self.fifo else self.output))
+                data.append(sample[register - 0x28])
+                if register == 0x2D:
+                    sample = None
+                    self.samples_read += 1
+                    self.data_ready = False
+                    if fifo and self.fifo:
+                        self.fifo.pop(0)
+                        if len(self.fifo) < self.FIFO_SIZE:
+                            self.fifo_overrun = False
+            else:
+                data.append(self._read(register))
+            if increment:
+                register += 1
+                if fifo and register == 0x2E:
+                    register = 0x28
+                register &= 0x3F
+        return data
+
+    def writeList(self, register, data):
+        with self.lock:
+            self._write_list(register, data)
+            rising = self._update_int1()
+        self._int1_edge(rising)
+
+    def _write_list(self, register, data):
+        self.transactions += 1
+        self.bytes_written += len(data)
+        self._generate()
+        increment = bool(register & 0x80) or len(data) > 1
+        register &= 0x7F
+        for value in data:
+            self.registers[register] = value & 0xFF
+            if register == 0x2E and value >> 6 == 0:  # bypass mode empties the FIFO
+                self.fifo = []
+                self.fifo_overrun = False
+            if increment:
+                register = (register + 1) & 0x3F
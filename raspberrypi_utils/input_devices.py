@@ -1,12 +1,20 @@
 from abc import ABCMeta, abstractmethod
+from collections import deque
+from heapq import heappop, heappush
 import logging
-from operator import add, div
-from threading import Thread
-from time import sleep
+from Queue import Empty, Full, Queue
+from threading import Condition, Event, Lock, Thread
+from time import sleep, time
 
+from dispatch import CallbackDispatcher
+from dsp import BaselineTracker
+from gpio import GPIO
 from LIS3DH import LIS3DH
-import RPi.GPIO as GPIO
-from yunomi import Meter
+from meter import Meter
+import metrics
+from utils import CalibrationCache, LazyModule, median, monotonic
+
+numpy = LazyModule('numpy')
 
 
 log = logging.getLogger(__name__)
@@ -14,85 +22,480 @@ log = logging.getLogger(__name__)
 
 class ThreadedDigitalInputDevice(object):
     __metaclass__ = ABCMeta
+    # dispatcher policy per event, the dispatcher's own (queue every event) for the others
+    dispatch_policies = {}
 
-    def __init__(self, immediate_callback=None, threshold_callback=None, threshold_seconds=0):
+    # Each device runs on its own thread, unless a runtime.DeviceRuntime is given, in which case it registers its
+    # periodic and edge-driven work on the runtime's single thread instead (see attach).
+    # Callbacks run on the sampling thread, unless a dispatch.CallbackDispatcher is given to run them on its workers.
+    # With acquire=False the device does neither, its readings are fed to it (e.g. by capture.replay).
+    def __init__(self, immediate_callback=None, threshold_callback=None, threshold_seconds=0, runtime=None,
+                 dispatcher=None, acquire=True):
         self.immediate_callback = immediate_callback
         self.threshold_callback = threshold_callback
         self.threshold_seconds = threshold_seconds
-        self.thread = Thread(target=self.run).start()
+        self.dispatcher = dispatcher
+        self.stop_event = Event()
+        self.subscribers = ()
+        self.subscribers_lock = Lock()
+        self.jobs = []
+        self.runtime = runtime
+        self.thread = None
+        self.metrics = metrics.get_registry()
+        self.metrics_label = self._metrics_label()
+        self.loop_period = self.metrics.histogram(
+            'device_loop_period_seconds', 'Time between two iterations of a device loop',
+            buckets=metrics.PERIOD_BUCKETS, device=self.metrics_label
+        )
+        self.dropped_readings = self.metrics.counter(
+            'device_dropped_readings_total', 'Readings dropped by slow readings() consumers', device=self.metrics_label
+        )
+        self.last_loop = None
+        self.callback_durations = {}  # event: histogram, created on the first callback
+        if not acquire:
+            self.runtime = None
+        elif runtime is None:
+            self.thread = Thread(target=self.run)
+            self.thread.start()
+        else:
+            runtime.add_device(self)
 
     @abstractmethod
     def run(self):
         pass
 
+    def _metrics_label(self):
+        return type(self).__name__
+
+    def _mark_loop(self):
+        # time since the previous iteration of the device's loop, only measured while metrics are enabled
+        if self.metrics.enabled:
+            now = time()
+            if self.last_loop is not None:
+                self.loop_period.observe(now - self.last_loop)
+            self.last_loop = now
+
     @abstractmethod
     def read(self):
         pass
 
+    @abstractmethod
+    def attach(self, runtime):
+        # register this device's work on the runtime, keeping the returned jobs in self.jobs
+        pass
+
+    def detach(self):
+        for job in self.jobs:
+            job.cancel()
+        self.jobs = []
+
+    def stop(self):
+        self.stop_event.set()
+        if self.runtime is not None:
+            self.runtime.remove_device(self)
+
+    def is_running(self):
+        if self.runtime is not None:
+            return not self.stop_event.is_set()
+        return self.thread is not None and self.thread.is_alive()
+
+    def readings(self, maxsize=100):
+        # iterate, from any thread, over the values passed to the immediate callback, until the device is stopped
+        # if the consumer falls behind by more than maxsize values, the newest are dropped
+        queue = Queue(maxsize)
+        with self.subscribers_lock:
+            self.subscribers = self.subscribers + (queue,)
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    yield queue.get(timeout=1)
+                except Empty:
+                    pass
+        finally:
+            with self.subscribers_lock:
+                self.subscribers = tuple(q for q in self.subscribers if q is not queue)
+
     def notify_immediate(self, *args):
-        if self.immediate_callback:
-            self.immediate_callback(*args)
+        # subscribers is replaced, never modified, so the sampling thread iterates without taking the lock
+        for queue in self.subscribers:
+            try:
+                queue.put_nowait(args)
+            except Full:
+                self.dropped_readings.inc()
+        self._notify('immediate', self.immediate_callback, args)
 
     def notify_threshold(self, *args):
-        if self.threshold_callback:
-            self.threshold_callback(*args)
+        self._notify('threshold', self.threshold_callback, args)
+
+    def _notify(self, event, callback, args):
+        if callback:
+            if self.dispatcher is not None:
+                self.dispatcher.submit(self, event, callback, args)
+            elif self.metrics.enabled:
+                start = time()
+                callback(*args)
+                duration = self.callback_durations.get(event)
+                if duration is None:
+                    duration = self.callback_durations[event] = self.metrics.histogram(
+                        'callback_seconds', 'Callback run time', dispatcher='', device=self.metrics_label, event=event
+                    )
+                duration.observe(time() - start)
+            else:
+                callback(*args)
 
 
 class Button(ThreadedDigitalInputDevice):
-    def __init__(self, pin, pressed_callback, hold_seconds=0, held_callback=None, pull_up_down=GPIO.PUD_DOWN):
+    def __init__(self, pin, pressed_callback, hold_seconds=0, held_callback=None, pull_up_down=GPIO.PUD_DOWN,
+                 runtime=None, dispatcher=None):
         self.pin = pin
         self.pull_up_down = pull_up_down
+        self.pressed_edge = GPIO.RISING if pull_up_down == GPIO.PUD_DOWN else GPIO.FALLING
+        self.released_edge = GPIO.FALLING if pull_up_down == GPIO.PUD_DOWN else GPIO.RISING
+        self.hold_job = None
         GPIO.setup(pin, GPIO.IN, pull_up_down=pull_up_down)
         super(Button, self).__init__(
             immediate_callback=pressed_callback,
             threshold_callback=held_callback,
-            threshold_seconds=hold_seconds
+            threshold_seconds=hold_seconds,
+            runtime=runtime,
+            dispatcher=dispatcher
         )
 
     def read(self):
         return GPIO.input(self.pin)
 
+    def _metrics_label(self):
+        return 'Button-{}'.format(self.pin)
+
+    def is_pressed(self):
+        return self.read() == (GPIO.HIGH if self.pull_up_down == GPIO.PUD_DOWN else GPIO.LOW)
+
     def run(self):
-        while True:
-            GPIO.wait_for_edge(self.pin, GPIO.RISING if self.pull_up_down == GPIO.PUD_DOWN else GPIO.FALLING)
+        while not self.stop_event.is_set():
+            # time out once a second to notice stop()
+            if GPIO.wait_for_edge(self.pin, self.pressed_edge, timeout=1000) is None:
+                continue
             log.debug('Button pressed')
             self.notify_immediate()
-            if not GPIO.wait_for_edge(self.pin, GPIO.FALLING if self.pull_up_down == GPIO.PUD_DOWN else GPIO.RISING,
-                                      timeout=self.threshold_seconds * 1000):
+            if not GPIO.wait_for_edge(self.pin, self.released_edge, timeout=self.threshold_seconds * 1000):
                 log.debug('Button held')
                 self.notify_threshold()
             else:
                 log.debug('Button released')
 
+    def attach(self, runtime):
+        GPIO.add_event_batch_detect(
+            self.pin, self.pressed_edge, lambda events: runtime.call_soon(self._pressed, events[-1][2])
+        )
+
+    def detach(self):
+        GPIO.remove_event_detect(self.pin)
+        if self.hold_job is not None:
+            self.hold_job.cancel()
+        super(Button, self).detach()
+
+    def _pressed(self, timestamp):
+        log.debug('Button pressed')
+        self.notify_immediate()
+        if self.threshold_callback:
+            if self.hold_job is not None:
+                self.hold_job.cancel()
+            # held is timed from the edge, not from when the runtime got to it
+            self.hold_job = self.runtime.call_later(
+                max(0, timestamp + self.threshold_seconds - time()), self._check_held
+            )
+
+    def _check_held(self):
+        self.hold_job = None
+        if self.is_pressed():
+            log.debug('Button held')
+            self.notify_threshold()
+        else:
+            log.debug('Button released')
+
+
+class _GroupedButton(object):
+    __slots__ = (
+        'pin', 'pressed_level', 'pressed_callback', 'released_callback', 'held_callback', 'hold_seconds',
+        'double_press_callback', 'double_press_seconds', 'pressed', 'settle_at', 'level', 'hold_token', 'last_press',
+        'metrics_label', 'callback_durations',
+    )
+
+    def __init__(self, pin, pressed_level, pressed_callback, released_callback, held_callback, hold_seconds,
+                 double_press_callback, double_press_seconds):
+        self.pin = pin
+        self.pressed_level = pressed_level
+        self.pressed_callback = pressed_callback
+        self.released_callback = released_callback
+        self.held_callback = held_callback
+        self.hold_seconds = hold_seconds
+        self.double_press_callback = double_press_callback
+        self.double_press_seconds = double_press_seconds
+        self.pressed = False
+        self.settle_at = None  # debounce deadline of the latest edge
+        self.level = None  # level after the latest edge, if the GPIO backend reports it
+        self.hold_token = 0  # bumped on every press and release, so stale hold deadlines are ignored
+        self.last_press = None
+        self.metrics_label = 'Button-{}'.format(pin)
+        self.callback_durations = {}
+
+
+class ButtonGroup(object):
+    # Any number of buttons served by one thread. GPIO edge callbacks only queue the edges; the group's thread
+    # debounces every pin (the level is taken once it has been stable for debounce_seconds) and times holds and
+    # double presses from a single heap of deadlines. Callbacks run on that thread, or on a dispatcher if given.
+    # Deadlines are computed from the edge timestamps, kernel timestamps with the gpiod backend.
+    SETTLE = 0
+    HOLD = 1
+
+    def __init__(self, debounce_seconds=0.02, dispatcher=None):
+        self.debounce_seconds = debounce_seconds
+        self.dispatcher = dispatcher
+        self.buttons = {}
+        self.condition = Condition()
+        self.edges = deque()
+        self.deadlines = []
+        self.metrics = metrics.get_registry()
+        self.running = False
+        self.thread = None
+
+    def add(self, pin, pressed_callback=None, held_callback=None, hold_seconds=1.0, double_press_callback=None,
+            double_press_seconds=0.4, released_callback=None, pull_up_down=GPIO.PUD_DOWN):
+        GPIO.setup(pin, GPIO.IN, pull_up_down=pull_up_down)
+        with self.condition:
+            self.buttons[pin] = _GroupedButton(
+                pin, GPIO.HIGH if pull_up_down == GPIO.PUD_DOWN else GPIO.LOW,
+                pressed_callback, released_callback, held_callback, hold_seconds,
+                double_press_callback, double_press_seconds
+            )
+        GPIO.add_event_batch_detect(pin, GPIO.BOTH, self._edges)
+
+    def remove(self, pin):
+        GPIO.remove_event_detect(pin)
+        with self.condition:
+            self.buttons.pop(pin, None)
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = Thread(target=self._run, name='ButtonGroup')
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        for pin in list(self.buttons):
+            self.remove(pin)
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def _edges(self, events):
+        # called on the GPIO backend's thread with (pin, level, timestamp) events, keep it short
+        with self.condition:
+            self.edges.extend(events)
+            self.condition.notify()
+
+    def _notify(self, event, button, callback):
+        if callback:
+            if self.dispatcher is not None:
+                self.dispatcher.submit(button, event, callback, (button.pin,))
+            elif self.metrics.enabled:
+                start = time()
+                callback(button.pin)
+                duration = button.callback_durations.get(event)
+                if duration is None:
+                    duration = button.callback_durations[event] = self.metrics.histogram(
+                        'callback_seconds', 'Callback run time', dispatcher='', device=button.metrics_label,
+                        event=event
+                    )
+                duration.observe(time() - start)
+            else:
+                callback(button.pin)
+
+    def _settle(self, button, now):
+        level = GPIO.input(button.pin) if button.level is None else button.level
+        pressed = level == button.pressed_level
+        if pressed == button.pressed:
+            return  # bounce, the level went back to where it was
+        button.pressed = pressed
+        button.hold_token += 1
+        if not pressed:
+            log.debug('Button {} released'.format(button.pin))
+            self._notify('released', button, button.released_callback)
+            return
+        log.debug('Button {} pressed'.format(button.pin))
+        self._notify('pressed', button, button.pressed_callback)
+        if button.double_press_callback:
+            if button.last_press is not None and now - button.last_press <= button.double_press_seconds:
+                log.debug('Button {} double pressed'.format(button.pin))
+                button.last_press = None
+                self._notify('double_pressed', button, button.double_press_callback)
+            else:
+                button.last_press = now
+        if button.held_callback:
+            heappush(self.deadlines, (now + button.hold_seconds, self.HOLD, button.pin, button.hold_token))
+
+    def _hold(self, button, token):
+        if button.pressed and button.hold_token == token:
+            log.debug('Button {} held'.format(button.pin))
+            self._notify('held', button, button.held_callback)
+
+    def _run(self):
+        while True:
+            due = []
+            with self.condition:
+                while self.running:
+                    while self.edges:
+                        pin, level, timestamp = self.edges.popleft()
+                        button = self.buttons.get(pin)
+                        if button is not None:
+                            button.level = level
+                            # every new edge pushes the debounce deadline back, only the latest one counts
+                            button.settle_at = timestamp + self.debounce_seconds
+                            heappush(self.deadlines, (button.settle_at, self.SETTLE, pin, None))
+                    now = time()
+                    while self.deadlines and self.deadlines[0][0] <= now:
+                        due.append(heappop(self.deadlines))
+                    if due:
+                        break
+                    self.condition.wait(self.deadlines[0][0] - now if self.deadlines else None)
+                if not self.running:
+                    return
+            for deadline, kind, pin, token in due:
+                button = self.buttons.get(pin)
+                if button is None:
+                    continue
+                if kind == self.SETTLE:
+                    if button.settle_at == deadline:
+                        self._settle(button, deadline)
+                else:
+                    self._hold(button, token)
+
 
 class VibrationSensor(ThreadedDigitalInputDevice):
+    # Acquisition modes
+    MODE_POLL = 'poll'  # read one sample every frequency_seconds
+    MODE_INTERRUPT = 'interrupt'  # wake on INT1, raised by the FIFO watermark or by data ready
+    MODE_MOTION = 'motion'  # the sensor compares against the sensitivity itself, wake on INT1 only on vibration
+
+    # the immediate callback is notified for every sample or block, a slow callback only needs the latest
+    # no vibration, but still gets every detection
+    dispatch_policies = {'immediate': CallbackDispatcher.KEEP_LATEST}
+
     def __init__(self, address=0x18, bus=1, frequency_seconds=1,
                  sensitivity=(0.05, 0.05, 0.05), auto_calibrate=True, auto_sensitivity=1.0,
-                 threshold_per_minute=1, vibration_callback=None, steady_vibration_callback=None):
-        GPIO.setmode(GPIO.BCM)
-        self.meter = Meter()
+                 threshold_per_minute=1, vibration_callback=None, steady_vibration_callback=None,
+                 mode=MODE_POLL, interrupt_pin=LIS3DH.INT_IO, fifo_watermark=16, motion_duration_seconds=0.0,
+                 calibration_cache=True, recalibrate=False,
+                 adaptive=False, adaptive_alpha=0.01, adaptive_k=4.0, adaptive_min_sensitivity=0.01,
+                 filters=None, spectrum=None, band_thresholds=None, band_callback=None, rate_window_seconds=60,
+                 runtime=None, dispatcher=None, bus_manager=None, transport=None, acquire=True):
+        if mode == self.MODE_MOTION and (filters is not None or spectrum is not None):
+            # the host never sees the samples in motion mode, only the sensor's motion events
+            raise Exception('Filters and spectrum analysis need samples, they cannot be used in motion mode')
+        if acquire:
+            GPIO.setmode(GPIO.BCM)  # not needed to only process fed samples, e.g. off a Raspberry Pi
+        self.rate_window_seconds = rate_window_seconds
+        self.meter = Meter(windows=sorted({10, 60, 300, rate_window_seconds}))
         self.frequency_seconds = frequency_seconds
         self.sensitivity = sensitivity
         self.auto_calibrate = auto_calibrate
         self.auto_sensitivity = auto_sensitivity
         self.threshold_per_minute = threshold_per_minute
         self.calibration = (0.0, 0.0, 0.0)
-        self.sensor = LIS3DH(address=address, bus=bus)
+        self.mode = mode
+        self.interrupt_pin = interrupt_pin
+        self.fifo_watermark = fifo_watermark
+        self.motion_duration_seconds = motion_duration_seconds
+        # calibration_cache: a utils.CalibrationCache, True for one at its default path, None to always calibrate
+        self.calibration_cache = CalibrationCache() if calibration_cache is True else calibration_cache
+        self.address = address
+        self.bus = bus
+        # with adaptive, calibration and sensitivity follow a baseline tracked while there is no vibration
+        self.baseline = BaselineTracker(
+            alpha=adaptive_alpha, k=adaptive_k, min_threshold=adaptive_min_sensitivity
+        ) if adaptive else None
+        self.steady_vibration = False
+        # optional dsp.FilterPipeline applied to the readings before detection, e.g. a high-pass to remove gravity
+        self.filters = filters
+        # optional dsp.SpectrumAnalyzer; with band_thresholds, detection is on band energy rather than amplitude
+        self.spectrum = spectrum
+        self.band_thresholds = band_thresholds
+        self.band_callback = band_callback
+        self.last_read = time()
+        self.last_motion = 0
+        # with a bus_manager, polling is done by the manager's sweeps (every sweep_seconds, which replace
+        # frequency_seconds for sampling), on its runtime unless one is given
+        self.bus_manager = bus_manager
+        if bus_manager is not None and self.mode == self.MODE_POLL and runtime is None:
+            runtime = bus_manager.runtime
+        # transport: an i2c.I2CTransport for the sensor, e.g. i2c.SimulatedLIS3DH
+        self.sensor = LIS3DH(address=address, bus=bus, bus_manager=bus_manager, transport=transport)
         if self.auto_calibrate:
-            self._calibrate()
+            if recalibrate:
+                self.recalibrate()
+            else:
+                self._calibrate()
+        if self.mode == self.MODE_INTERRUPT:
+            self._setup_interrupt()
+        elif self.mode == self.MODE_MOTION:
+            self._setup_motion()
         super(VibrationSensor, self).__init__(
             vibration_callback,
-            steady_vibration_callback
+            steady_vibration_callback,
+            runtime=runtime,
+            dispatcher=dispatcher,
+            acquire=acquire
         )
 
-    def _calibrate(self, iterations=50):
+    def _setup_interrupt(self):
+        # with a watermark, INT1 is raised once per batch of samples, otherwise once per sample (data ready)
+        if self.fifo_watermark:
+            self.sensor.set_fifo_mode(LIS3DH.FIFO_STREAM, self.fifo_watermark)
+            self.sensor.set_fifo_watermark_interrupt()
+        else:
+            self.sensor.set_data_ready_interrupt()
+
+    def _setup_motion(self):
+        # The sensor has a single threshold, compared after high-pass filtering out gravity. Axis whose sensitivity
+        # is 1g or more (the gravity axis after auto calibration) can't trigger on the host either, so leave them out.
+        axes = [i for i in xrange(3) if self.sensitivity[i] < 1.0] or range(3)
+        threshold = min(self.sensitivity[i] for i in axes)
+        duration = int(round(self.motion_duration_seconds * self.sensor.get_data_rate_hz()))
+        log.debug('VibrationSensor: motion threshold {} on axis {}, duration {} samples'.format(
+            threshold, axes, duration))
+        self.sensor.set_motion_interrupt(threshold, duration=duration, axes=axes)
+
+    def _metrics_label(self):
+        return 'VibrationSensor-{}:0x{:02X}'.format(self.bus, self.address)
+
+    def _calibration_key(self):
+        return '{}:0x{:02X}:{}'.format(self.bus, self.address, self.sensor.get_range())
+
+    def _calibrate(self, samples=128):
+        key = self._calibration_key()
+        if self.calibration_cache:
+            cached = self.calibration_cache.get(key)
+            if cached and cached.get('auto_sensitivity') == self.auto_sensitivity:
+                self.calibration = cached['calibration']
+                self.sensitivity = cached['sensitivity']
+                log.debug('VibrationSensor: cached calibration (x, y, z) = {}, sensitivity (x, y, z) = {}'.format(
+                    self.calibration, self.sensitivity))
+                return
+
+        # a burst of consecutive samples through the FIFO, 128 samples take about 0.3s at 400Hz
+        self.calibrate_block(self.sensor.read_block(samples))
+        if self.calibration_cache:
+            self.calibration_cache.put(key, calibration=self.calibration, sensitivity=self.sensitivity,
+                                       auto_sensitivity=self.auto_sensitivity)
+
+    def calibrate_block(self, block):
+        # calibration and sensitivity from a (n, 3) block of samples in g taken without vibration
         # figure out which axis is measuring gravity, and calibrate accordingly to ignore its effect
-        totals = [0, 0, 0]
-        for i in xrange(iterations):
-            readings = [abs(self.sensor.get_x()), abs(self.sensor.get_y()), abs(self.sensor.get_z())]
-            totals = map(add, readings, totals)
-            sleep(0.2)
-        self.calibration = [round(x, 3) for x in map(div, totals, [iterations]*3)]
+        self.calibration = [round(x, 3) for x in numpy.abs(block).mean(axis=0).tolist()]
         log.debug('VibrationSensor: self calibration (x, y, z) = {}'.format(self.calibration))
         self.sensitivity = []
         for x in self.calibration:
@@ -106,9 +509,16 @@ class VibrationSensor(ThreadedDigitalInputDevice):
             self.sensitivity.append(round(x, 3))
         log.debug('VibrationSensor: calculated sensitivity (x, y, z) = {}'.format(self.sensitivity))
 
+    def recalibrate(self):
+        # ignore (and drop) any cached calibration
+        if self.calibration_cache:
+            self.calibration_cache.invalidate(self._calibration_key())
+        self._calibrate()
+
     def read(self):
-        rate = self.meter.get_one_minute_rate()
-        if rate > self.threshold_per_minute:
+        rate = self.meter.get_rate(self.rate_window_seconds)
+        self.steady_vibration = rate > self.threshold_per_minute  # freezes baseline adaptation
+        if self.steady_vibration:
             log.debug('VibrationSensor: rate {:.2f} above threshold {:.2f}, steady callback'.format(
                 rate, self.threshold_per_minute)
             )
@@ -116,38 +526,233 @@ class VibrationSensor(ThreadedDigitalInputDevice):
         return rate
 
     def reset(self):
-        self.meter = Meter()
+        self.meter.reset()
+
+    def update_config(self, values):
+        # apply live configuration changes, e.g. ConfigService.subscribe(sensor.update_config, section='VIBRATION')
+        if values.get('SENSITIVITY') is not None:
+            self.sensitivity = values['SENSITIVITY']
+            if self.mode == self.MODE_MOTION:
+                self._setup_motion()  # the sensor compares against its own copy of the threshold
+        if values.get('THRESHOLD_PER_MINUTE') is not None:
+            self.threshold_per_minute = values['THRESHOLD_PER_MINUTE']
+        if values.get('FREQUENCY_SECONDS') is not None and values['FREQUENCY_SECONDS'] != self.frequency_seconds:
+            self.frequency_seconds = values['FREQUENCY_SECONDS']
+            if self.runtime is not None and not self.stop_event.is_set():
+                # the periodic jobs (or the bus manager's sweeps) were scheduled with the previous period
+                self.detach()
+                self.attach(self.runtime)
+        log.debug('VibrationSensor: configuration updated, sensitivity (x, y, z) = {}, threshold {}'.format(
+            self.sensitivity, self.threshold_per_minute))
+
+    def _detect(self, readings):
+        if self.filters is not None or self.spectrum is not None:
+            # the filters and the spectrum analyzer keep state across samples, they only work on blocks
+            return self._detect_block(numpy.array([readings])) > 0
+        readings = [abs(round(x, 3)) for x in readings]
+        log.debug('VibrationSensor: readings (x, y, z) = {}'.format(readings))
+        if any(True for i in xrange(3) if abs(readings[i] - self.calibration[i]) > self.sensitivity[i]):
+            self.meter.mark()
+            log.debug('VibrationSensor meter marked')
+            return True
+        if self.baseline is not None and not self.steady_vibration:
+            self.baseline.update(readings)
+            self._adapt()
+        return False
+
+    def _detect_block(self, block):
+        # vectorized _detect over a (n, 3) block of readings, returns the number of samples above sensitivity
+        if self.spectrum is not None:
+            exceeding_windows = self._analyze_spectrum(block)
+            if self.band_thresholds is not None:
+                return exceeding_windows
+        if self.filters is not None:
+            readings = numpy.abs(self.filters.process(block))
+            offsets, sensitivity = self._gravity_free_calibration()
+        else:
+            readings = numpy.abs(numpy.round(block, 3))
+            offsets = self.calibration
+            sensitivity = self.sensitivity
+        exceeding_rows = (numpy.abs(readings - offsets) > sensitivity).any(axis=1)
+        exceeding = int(numpy.count_nonzero(exceeding_rows))
+        if exceeding:
+            self.meter.mark(exceeding)
+            log.debug('VibrationSensor meter marked {} times'.format(exceeding))
+        if self.baseline is not None and not self.steady_vibration:
+            self.baseline.update_block(readings[~exceeding_rows])
+            self._adapt()
+        return exceeding
+
+    def _analyze_spectrum(self, block):
+        # feed the spectrum analyzer, returns the number of completed windows with a band above its threshold
+        exceeding = 0
+        for energies in self.spectrum.process(block):
+            log.debug('VibrationSensor: band energies = {}'.format(energies))
+            self.notify_bands(energies)
+            if self.band_thresholds is not None and (energies > self.band_thresholds).any():
+                exceeding += 1
+        if exceeding:
+            self.meter.mark(exceeding)
+            log.debug('VibrationSensor meter marked {} times'.format(exceeding))
+        return exceeding
+
+    def notify_bands(self, energies):
+        self._notify('bands', self.band_callback, (energies,))
+
+    def _gravity_free_calibration(self):
+        # filtered readings have no gravity component, so the gravity axis (calibrated at about 1g) borrows the
+        # calibration and sensitivity of the other axis, which only measure noise
+        gravity = [round(c) >= 1 for c in self.calibration]
+        if all(gravity) or not any(gravity):
+            return self.calibration, self.sensitivity
+        offset = min(c for c, g in zip(self.calibration, gravity) if not g)
+        sensitivity = min(s for s, g in zip(self.sensitivity, gravity) if not g)
+        return (
+            [offset if g else c for c, g in zip(self.calibration, gravity)],
+            [sensitivity if g else s for s, g in zip(self.sensitivity, gravity)],
+        )
+
+    def _adapt(self):
+        if self.baseline.is_ready():
+            self.calibration = list(self.baseline.mean)
+            self.sensitivity = self.baseline.thresholds()
 
     def run(self):
-        while True:
-            readings = [abs(round(x, 3)) for x in (self.sensor.get_x(), self.sensor.get_y(), self.sensor.get_z())]
-            log.debug('VibrationSensor: readings (x, y, z) = {}'.format(readings))
-            if any(True for i in xrange(3) if abs(readings[i] - self.calibration[i]) > self.sensitivity[i]):
+        if self.mode == self.MODE_INTERRUPT:
+            self._run_interrupt()
+        elif self.mode == self.MODE_MOTION:
+            self._run_motion()
+        else:
+            self._run_poll()
+
+    def attach(self, runtime):
+        if self.mode == self.MODE_INTERRUPT:
+            self.sensor.set_interrupt(lambda channel: runtime.call_soon(self._interrupt_step), pin=self.interrupt_pin)
+            # the periodic step also covers an edge missed before the callback was registered
+            self.jobs = [runtime.schedule_periodic(self.frequency_seconds, self._interrupt_step)]
+        elif self.mode == self.MODE_MOTION:
+            self.sensor.set_interrupt(lambda channel: runtime.call_soon(self._motion_step, True),
+                                      pin=self.interrupt_pin)
+            self.sensor.get_motion_source()  # clear an event latched before the callback was registered
+            self.jobs = [runtime.schedule_periodic(self.frequency_seconds, self._motion_step, False)]
+        elif self.bus_manager is not None:
+            self.bus_manager.register(self.sensor, self._sweep_step, self.frequency_seconds)
+        else:
+            self.jobs = [runtime.schedule_periodic(self.frequency_seconds, self._poll_step)]
+
+    def detach(self):
+        if self.mode in (self.MODE_INTERRUPT, self.MODE_MOTION):
+            self.sensor.clear_interrupt(pin=self.interrupt_pin)
+        elif self.bus_manager is not None:
+            self.bus_manager.unregister(self.sensor)
+        super(VibrationSensor, self).detach()
+
+    def _read_if_due(self, now=None):
+        now = time() if now is None else now
+        if now - self.last_read >= self.frequency_seconds:
+            self.last_read = now
+            self.read()
+
+    def process_block(self, block, now=None):
+        # detection over a (n, 3) block of samples in g, read from the FIFO or replayed (see capture.replay)
+        if len(block):
+            self.notify_immediate(self._detect_block(block) > 0)
+        self._read_if_due(now)
+
+    def _poll_step(self):
+        self._mark_loop()
+        self.notify_immediate(self._detect(self.sensor.get_xyz()))
+        self.read()
+
+    def _sweep_step(self, readings):
+        self._mark_loop()
+        self.notify_immediate(self._detect(readings))
+        self._read_if_due()
+
+    def _interrupt_step(self):
+        self._mark_loop()
+        if self.fifo_watermark:
+            self.process_block(self.sensor.drain_fifo_array()[1])
+        else:
+            self.notify_immediate(self._detect(self.sensor.get_xyz()))
+            self._read_if_due()
+
+    def _motion_step(self, fired):
+        self._mark_loop()
+        if fired:
+            if self.sensor.get_motion_source() & LIS3DH.INT_ACTIVE:
+                self.last_motion = time()
                 self.meter.mark()
                 log.debug('VibrationSensor meter marked')
                 self.notify_immediate(True)
-            else:
-                self.notify_immediate(False)
-            self.read()
-            sleep(self.frequency_seconds)
+        elif time() - self.last_motion >= self.frequency_seconds:
+            self.notify_immediate(False)
+        self._read_if_due()
+
+    def _run_poll(self):
+        while not self.stop_event.is_set():
+            self._poll_step()
+            self.stop_event.wait(self.frequency_seconds)
+
+    def _run_interrupt(self):
+        data_ready = Event()
+        self.sensor.set_interrupt(lambda channel: data_ready.set(), pin=self.interrupt_pin)
+        while not self.stop_event.is_set():
+            # the timeout also covers an edge missed before the callback was registered, since reading clears INT1
+            data_ready.wait(self.frequency_seconds)
+            data_ready.clear()
+            self._interrupt_step()
+        self.sensor.clear_interrupt(pin=self.interrupt_pin)
+
+    def _run_motion(self):
+        motion = Event()
+        self.sensor.set_interrupt(lambda channel: motion.set(), pin=self.interrupt_pin)
+        self.sensor.get_motion_source()  # clear an event latched before the callback was registered
+        while not self.stop_event.is_set():
+            fired = motion.wait(self.frequency_seconds)
+            motion.clear()
+            self._motion_step(fired)
+        self.sensor.clear_interrupt(pin=self.interrupt_pin)
 
 
 class LightSensor(ThreadedDigitalInputDevice):
-    def __init__(self, pin, light_callback, on_threshold=500, frequency=10):
+    # Reading modes
+    MODE_COUNT = 'count'  # spin counting loop iterations while the capacitor charges, depends on CPU speed and load
+    MODE_TIMED = 'timed'  # wait for the rising edge and time the charge, in microseconds, without spinning
+
+    # Readings are loop iterations in count mode and microseconds in timed mode, the light is on when the reading
+    # is at most on_threshold, which defaults per mode
+    DEFAULT_ON_THRESHOLDS = {
+        MODE_COUNT: 500,  # loop iterations
+        MODE_TIMED: 1000,  # microseconds
+    }
+
+    def __init__(self, pin, light_callback, on_threshold=None, frequency=10, runtime=None, dispatcher=None,
+                 mode=MODE_COUNT, samples=1, timeout_ms=1000):
         self.pin = pin
-        self.on_threshold = on_threshold
+        self.on_threshold = self.DEFAULT_ON_THRESHOLDS[mode] if on_threshold is None else on_threshold
         self.frequency = frequency
+        self.mode = mode
+        self.samples = samples
+        self.timeout_ms = timeout_ms
         self.is_on = None
         GPIO.setup(pin, GPIO.OUT)
         super(LightSensor, self).__init__(
             immediate_callback=light_callback,
+            runtime=runtime,
+            dispatcher=dispatcher
         )
 
-    def read(self):
-        # based on https://learn.adafruit.com/basic-resistor-sensor-reading-on-raspberry-pi/basic-photocell-reading
+    def _discharge(self):
         GPIO.setup(self.pin, GPIO.OUT)
         GPIO.output(self.pin, GPIO.LOW)
         sleep(0.1)
+
+    def read(self):
+        # based on https://learn.adafruit.com/basic-resistor-sensor-reading-on-raspberry-pi/basic-photocell-reading
+        if self.mode == self.MODE_TIMED:
+            return self._read_timed()
+        self._discharge()
         GPIO.setup(self.pin, GPIO.IN)
 
         reading = 0
@@ -155,11 +760,41 @@ class LightSensor(ThreadedDigitalInputDevice):
             reading += 1
         return reading
 
+    def _read_timed(self):
+        # median charge time in microseconds over self.samples readings, None if it's too dark to charge in time
+        # the rising edge is timed by the kernel with the gpiod backend, when wait_for_edge returns otherwise, both on
+        # the monotonic clock; the charge is timed from when the pin is an input, after the setup call returns
+        readings = []
+        for i in xrange(self.samples):
+            self._discharge()
+            GPIO.setup(self.pin, GPIO.IN)
+            start = monotonic()
+            charged = GPIO.wait_for_edge_timestamp(self.pin, GPIO.RISING, timeout=self.timeout_ms)
+            if charged is None:
+                continue
+            readings.append(max(0.0, charged - start) * 1e6)
+        if not readings:
+            log.debug('LightSensor: no charge within {}ms, dark'.format(self.timeout_ms))
+            return None
+        return median(readings)
+
+    def _metrics_label(self):
+        return 'LightSensor-{}'.format(self.pin)
+
+    def step(self):
+        self._mark_loop()
+        reading = self.read()
+        is_on_now = reading is not None and reading <= self.on_threshold
+        if self.is_on is None or is_on_now != self.is_on:
+            self.is_on = is_on_now
+            log.debug('Light turned {}'.format('on' if self.is_on else 'off'))
+            self.notify_immediate(self.is_on)
+
     def run(self):
-        while True:
-            is_on_now = self.read() <= self.on_threshold
-            if self.is_on is None or is_on_now != self.is_on:
-                self.is_on = is_on_now
-                log.debug('Light turned {}'.format('on' if self.is_on else 'off'))
-                self.notify_immediate(self.is_on)
-            sleep(self.frequency)
+        while not self.stop_event.is_set():
+            self.step()
+            self.stop_event.wait(self.frequency)
+
+    def attach(self, runtime):
+        runtime.call_soon(self.step)
+        self.jobs = [runtime.schedule_periodic(self.frequency, self.step)]
@@ -0,0 +1,96 @@
+from math import exp
+from threading import Lock
+from time import time
+
+
+class Meter(object):
+    # Thread-safe event rate estimator, a lightweight replacement for yunomi's Meter.
+    # Keeps an exponentially weighted moving average (EWMA) rate, in events per second, for each window in
+    # 'windows' (seconds), ticked every 'tick_seconds', plus exact event counts over the last 'ring_seconds',
+    # in a fixed-size ring of 'ring_buckets' buckets. mark() and all reads are O(1), except get_window_count()
+    # which is O(ring_buckets). 'clock' can be replaced, e.g. to replay recorded samples faster than real time.
+    __slots__ = (
+        'windows', 'tick_seconds', 'alphas', 'clock', 'lock', 'rates', 'uncounted', 'last_tick', 'start_time',
+        'count', 'bucket_seconds', 'buckets', 'bucket', 'ring_seconds',
+    )
+
+    def __init__(self, windows=(10, 60, 300), tick_seconds=1, ring_seconds=60, ring_buckets=60, clock=time):
+        self.windows = tuple(windows)
+        self.tick_seconds = float(tick_seconds)
+        self.alphas = [1.0 - exp(-self.tick_seconds / window) for window in self.windows]
+        self.clock = clock
+        self.lock = Lock()
+        self.ring_seconds = ring_seconds
+        self.bucket_seconds = float(ring_seconds) / ring_buckets
+        self.buckets = [0] * ring_buckets
+        self._reset()
+
+    def _reset(self):
+        now = self.clock()
+        self.rates = [None] * len(self.windows)
+        self.uncounted = 0
+        self.last_tick = now
+        self.start_time = now
+        self.count = 0
+        self.bucket = int(now / self.bucket_seconds)
+        for i in xrange(len(self.buckets)):
+            self.buckets[i] = 0
+
+    def reset(self):
+        with self.lock:
+            self._reset()
+
+    def _tick_if_necessary(self, now):
+        ticks = int((now - self.last_tick) / self.tick_seconds)
+        if ticks > 0:
+            self.last_tick += ticks * self.tick_seconds
+            instant_rate = self.uncounted / self.tick_seconds
+            self.uncounted = 0
+            for i, alpha in enumerate(self.alphas):
+                rate = self.rates[i]
+                rate = instant_rate if rate is None else rate + alpha * (instant_rate - rate)
+                # any further ticks saw no events, decay them all at once
+                self.rates[i] = rate * (1.0 - alpha) ** (ticks - 1)
+
+        bucket = int(now / self.bucket_seconds)
+        if bucket != self.bucket:
+            size = len(self.buckets)
+            for b in xrange(self.bucket + 1, min(bucket, self.bucket + size) + 1):
+                self.buckets[b % size] = 0
+            self.bucket = bucket
+
+    def mark(self, n=1):
+        with self.lock:
+            now = self.clock()
+            self._tick_if_necessary(now)
+            self.uncounted += n
+            self.count += n
+            self.buckets[self.bucket % len(self.buckets)] += n
+
+    def get_count(self):
+        return self.count
+
+    def get_mean_rate(self):
+        with self.lock:
+            elapsed = self.clock() - self.start_time
+            return self.count / elapsed if elapsed > 0 else 0.0
+
+    def get_rate(self, window):
+        # EWMA rate, in events per second, for one of the configured windows
+        index = self.windows.index(window)
+        with self.lock:
+            self._tick_if_necessary(self.clock())
+            return self.rates[index] or 0.0
+
+    def get_one_minute_rate(self):
+        return self.get_rate(60)
+
+    def get_window_count(self, seconds=None):
+        # exact number of events in the last 'seconds' (up to ring_seconds), with the resolution of one bucket
+        buckets = len(self.buckets)
+        if seconds is not None:
+            buckets = min(buckets, max(1, int(round(seconds / self.bucket_seconds))))
+        with self.lock:
+            self._tick_if_necessary(self.clock())
+            size = len(self.buckets)
+            return sum(self.buckets[(self.bucket - i) % size] for i in xrange(buckets))
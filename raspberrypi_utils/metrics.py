@@ -0,0 +1,216 @@
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from bisect import bisect_left
+import json
+import logging
+from threading import Lock, Thread
+
+
+log = logging.getLogger(__name__)
+
+
+# Latency buckets, in seconds, from an I2C transaction to a slow callback
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# Loop period buckets, in seconds, for loops running every few milliseconds to every few minutes
+PERIOD_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+class Counter(object):
+    __slots__ = ('name', 'labels', 'lock', 'value')
+    type = 'counter'
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.lock = Lock()
+        self.value = 0
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def sample(self):
+        return self.value
+
+
+class Gauge(Counter):
+    __slots__ = ()
+    type = 'gauge'
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, n=1):
+        self.inc(-n)
+
+
+class Histogram(object):
+    # counts of observations per fixed bucket (upper bounds), plus their sum and count
+    __slots__ = ('name', 'labels', 'lock', 'buckets', 'counts', 'sum', 'count')
+    type = 'histogram'
+
+    def __init__(self, name, labels, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.labels = labels
+        self.lock = Lock()
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def sample(self):
+        with self.lock:
+            return {'buckets': zip(self.buckets, self.counts), 'inf': self.counts[-1], 'sum': self.sum,
+                    'count': self.count}
+
+
+class _NullMetric(object):
+    # what a disabled registry hands out, every method does nothing
+    __slots__ = ()
+
+    def inc(self, n=1):
+        pass
+
+    def dec(self, n=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+NULL_METRIC = _NullMetric()
+
+
+class MetricsRegistry(object):
+    # Counters, gauges and histograms, identified by name and labels, created on first use. While disabled, every
+    # metric is NULL_METRIC, and the instrumented code checks 'enabled' to skip timing altogether, so metrics must be
+    # enabled before creating the devices to be measured.
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.lock = Lock()
+        self.metrics = {}
+        self.help = {}
+
+    def _get(self, cls, name, help, labels, *args):
+        if not self.enabled:
+            return NULL_METRIC
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.get(key)
+                if metric is None:
+                    metric = self.metrics[key] = cls(name, key[1], *args)
+                    if help:
+                        self.help[name] = help
+        return metric
+
+    def counter(self, name, help='', **labels):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help='', **labels):
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name, help='', buckets=DEFAULT_BUCKETS, **labels):
+        return self._get(Histogram, name, help, labels, buckets)
+
+    def _sorted(self):
+        with self.lock:
+            return sorted(self.metrics.items(), key=lambda item: item[0])
+
+    def stats(self):
+        # {name: [{'labels': {...}, 'value': ...}, ...]}, histogram values are dicts of buckets, sum and count
+        stats = {}
+        for (name, labels), metric in self._sorted():
+            stats.setdefault(name, []).append({'labels': dict(labels), 'value': metric.sample()})
+        return stats
+
+    def prometheus_text(self):
+        lines = []
+        previous = None
+        for (name, labels), metric in self._sorted():
+            if name != previous:
+                if name in self.help:
+                    lines.append('# HELP {} {}'.format(name, self.help[name]))
+                lines.append('# TYPE {} {}'.format(name, metric.type))
+                previous = name
+            if metric.type != 'histogram':
+                lines.append('{}{} {}'.format(name, _format_labels(labels), metric.sample()))
+                continue
+            sample = metric.sample()
+            cumulative = 0
+            for bound, count in sample['buckets']:
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(name, _format_labels(labels + (('le', repr(bound)),)), cumulative))
+            lines.append('{}_bucket{} {}'.format(name, _format_labels(labels + (('le', '+Inf'),)), sample['count']))
+            lines.append('{}_sum{} {!r}'.format(name, _format_labels(labels), sample['sum']))
+            lines.append('{}_count{} {}'.format(name, _format_labels(labels), sample['count']))
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self.lock:
+            self.metrics = {}
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels
+    ) + '}'
+
+
+registry = MetricsRegistry(enabled=False)
+
+
+def get_registry():
+    return registry
+
+
+def enable():
+    registry.enabled = True
+    return registry
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body, content_type = self.server.registry.prometheus_text(), 'text/plain; version=0.0.4'
+        elif self.path == '/stats':
+            body, content_type = json.dumps(self.server.registry.stats()), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug('MetricsServer: ' + format % args)
+
+
+class MetricsServer(object):
+    # Serves the registry in the Prometheus text format on /metrics, and as JSON on /stats, from a daemon thread.
+    # Listens on localhost only, unless another host is given.
+    def __init__(self, registry=registry, port=9105, host='127.0.0.1'):
+        self.server = HTTPServer((host, port), _Handler)
+        self.server.registry = registry
+        self.thread = Thread(target=self.server.serve_forever, name='MetricsServer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
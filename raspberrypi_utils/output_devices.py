@@ -1,14 +1,28 @@
 from abc import ABCMeta, abstractmethod
-from threading import Thread, Event
+from heapq import heappop, heappush
+from itertools import count
+import logging
+from threading import Condition, Thread, Event
+from time import time
 
-from arrow import now
-import RPi.GPIO as GPIO
+from gpio import GPIO
+from utils import LazyModule
+
+arrow = LazyModule('arrow')
+
+
+log = logging.getLogger(__name__)
 
 
 class DigitalOutputDevice(object):
+    pwm_output = False  # drive the pin through PWM even for on/off values, e.g. for passive buzzers
+    pwm_frequency = 100
+    on_duty_cycle = 100
+
     def __init__(self, pin, initial_on=False, on_high_logic=True):
         self.pin = pin
         self.on_high_logic = on_high_logic
+        self.pwm = None
         GPIO.setmode(GPIO.BCM)
         GPIO.setup(pin, GPIO.OUT, initial=GPIO.HIGH if initial_on and on_high_logic else GPIO.LOW)
 
@@ -18,18 +32,42 @@ class DigitalOutputDevice(object):
     def off(self):
         GPIO.output(self.pin, GPIO.LOW if self.on_high_logic else GPIO.HIGH)
 
+    def level(self, on):
+        # the GPIO level that turns the device on or off
+        return GPIO.HIGH if bool(on) == self.on_high_logic else GPIO.LOW
+
+    def set_duty_cycle(self, duty_cycle):
+        if not self.on_high_logic:
+            duty_cycle = 100 - duty_cycle
+        if self.pwm is None:
+            self.pwm = GPIO.PWM(self.pin, self.pwm_frequency)
+            self.pwm.start(duty_cycle)
+        else:
+            self.pwm.ChangeDutyCycle(duty_cycle)
+
+    def stop_pwm(self):
+        if self.pwm is not None:
+            self.pwm.stop()
+            self.pwm = None
+
 
 class ThreadedDigitalOutputDevice(DigitalOutputDevice):
     __metaclass__ = ABCMeta
 
-    def __init__(self, pin, initial_on=False, on_high_logic=True):
+    # Each activation runs on its own thread, unless a Sequencer is given, in which case the device's pattern is
+    # played by the sequencer's single thread instead
+    def __init__(self, pin, initial_on=False, on_high_logic=True, sequencer=None):
         super(ThreadedDigitalOutputDevice, self).__init__(pin, initial_on=initial_on, on_high_logic=on_high_logic)
         self.stop_event = Event()
         self.on_after_stop = False
         self.thread = None
+        self.sequencer = sequencer
 
     def start(self):
-        if self.thread and self.thread.is_alive:
+        if self.is_running():
+            return
+        if self.sequencer is not None:
+            self.sequencer.play(self, self.pattern())
             return
         if self.stop_event.isSet():
             self.stop_event.clear()
@@ -37,13 +75,29 @@ class ThreadedDigitalOutputDevice(DigitalOutputDevice):
         self.thread.start()
 
     def stop(self, on_after_stop=False):
+        if self.sequencer is not None:
+            self.sequencer.stop(self, on_after_stop=on_after_stop)
+            return
         if self.is_running() and not self.stop_event.isSet():
             self.on_after_stop = on_after_stop
             self.stop_event.set()
+            self.thread.join()  # quick, _run only ever waits on stop_event
             self.thread = None
 
     def is_running(self):
-        return self.thread and self.thread.is_alive
+        if self.sequencer is not None:
+            return self.sequencer.is_playing(self)
+        return self.thread is not None and self.thread.is_alive()
+
+    def play(self, pattern, on_after_stop=False):
+        # play any Pattern (see Pattern.morse, Pattern.fade, ...), requires a sequencer
+        if self.sequencer is None:
+            raise Exception('Playing patterns requires a Sequencer')
+        self.sequencer.play(self, pattern, on_after_stop=on_after_stop)
+
+    def pattern(self):
+        # the pattern played by start() when using a sequencer, plain on/off unless the device has its own
+        return Pattern.blink()
 
     @abstractmethod
     def _run(self):
@@ -51,15 +105,20 @@ class ThreadedDigitalOutputDevice(DigitalOutputDevice):
 
 
 class LED(ThreadedDigitalOutputDevice):
-    def __init__(self, pin, initial_on=False, on_high_logic=True):
-        self.on_seconds = None
-        self.off_seconds = None
-        super(LED, self).__init__(pin, initial_on=initial_on, on_high_logic=on_high_logic)
+    def __init__(self, pin, initial_on=False, on_high_logic=True, sequencer=None):
+        # the Pattern.blink defaults until flash() is called, for start() on its own
+        self.on_seconds = 0.25
+        self.off_seconds = 0.25
+        super(LED, self).__init__(pin, initial_on=initial_on, on_high_logic=on_high_logic, sequencer=sequencer)
 
     def is_flashing(self):
-        self.is_running()
+        return self.is_running()
+
+    def pattern(self):
+        return Pattern.blink(self.on_seconds, self.off_seconds)
 
     def flash(self, on_seconds=0.25, off_seconds=0.25):
+        Pattern.blink(on_seconds, off_seconds)  # raises ValueError before changing anything, e.g. for flash(0, 0)
         self.on_seconds = on_seconds
         self.off_seconds = off_seconds
         self.start()
@@ -90,16 +149,23 @@ class LED(ThreadedDigitalOutputDevice):
 
 
 class Buzzer(ThreadedDigitalOutputDevice):
-    def __init__(self, pin, freq, quiet_hours, initial_on=False, on_high_logic=True):
-        super(Buzzer, self).__init__(pin, initial_on=initial_on, on_high_logic=on_high_logic)
+    pwm_output = True
+    on_duty_cycle = 50
+
+    def __init__(self, pin, freq, quiet_hours, initial_on=False, on_high_logic=True, sequencer=None):
+        super(Buzzer, self).__init__(pin, initial_on=initial_on, on_high_logic=on_high_logic, sequencer=sequencer)
         self.freq = freq
+        self.pwm_frequency = freq
         self.quiet_hours = quiet_hours
         self.buzzer = None
 
+    def pattern(self):
+        return Pattern.blink(1, 0.2)
+
     def is_quiet_hours(self):
         if self.quiet_hours is None:
             return False
-        hour = now('US/Eastern').hour
+        hour = arrow.now('US/Eastern').hour
         if self.quiet_hours[1] > self.quiet_hours[0]:
             return self.quiet_hours[0] <= hour <= self.quiet_hours[1]
         else:
@@ -110,6 +176,11 @@ class Buzzer(ThreadedDigitalOutputDevice):
             return
         super(Buzzer, self).start()
 
+    def play(self, pattern, on_after_stop=False):
+        if self.is_quiet_hours():
+            return
+        super(Buzzer, self).play(pattern, on_after_stop=on_after_stop)
+
     def _run(self):
         self.buzzer = GPIO.PWM(self.pin, self.freq)
         self.buzzer.start(50)
@@ -121,3 +192,172 @@ class Buzzer(ThreadedDigitalOutputDevice):
         self.stop_event.clear()
         self.buzzer.stop()
         self.buzzer = None
+
+
+class Pattern(object):
+    # Precomputed output pattern: a list of (offset seconds, value) transitions over one cycle of 'duration' seconds,
+    # repeated 'repeat' times (forever if None). Values are on/off (True/False) or a PWM duty cycle (0-100).
+    MORSE = {
+        'A': '.-', 'B': '-...', 'C': '-.-.', 'D': '-..', 'E': '.', 'F': '..-.', 'G': '--.', 'H': '....', 'I': '..',
+        'J': '.---', 'K': '-.-', 'L': '.-..', 'M': '--', 'N': '-.', 'O': '---', 'P': '.--.', 'Q': '--.-', 'R': '.-.',
+        'S': '...', 'T': '-', 'U': '..-', 'V': '...-', 'W': '.--', 'X': '-..-', 'Y': '-.--', 'Z': '--..',
+        '0': '-----', '1': '.----', '2': '..---', '3': '...--', '4': '....-', '5': '.....', '6': '-....',
+        '7': '--...', '8': '---..', '9': '----.',
+    }
+
+    def __init__(self, transitions, duration, repeat=None):
+        # the sequencer schedules every cycle after the previous one, an empty cycle would never let it move on
+        if not duration > 0:
+            raise ValueError('Pattern duration must be positive, got {}'.format(duration))
+        if any(not 0 <= offset < duration for offset, _ in transitions):
+            raise ValueError('Pattern transitions must be within [0, {}) seconds'.format(duration))
+        self.transitions = sorted(transitions, key=lambda transition: transition[0])
+        self.duration = duration
+        self.repeat = repeat
+
+    @classmethod
+    def blink(cls, on_seconds=0.25, off_seconds=0.25, repeat=None):
+        # a zero on or off time leaves the output steadily off or on
+        transitions = [(0, True)] if on_seconds else []
+        if off_seconds:
+            transitions.append((on_seconds, False))
+        return cls(transitions, on_seconds + off_seconds, repeat=repeat)
+
+    @classmethod
+    def beeps(cls, count, on_seconds=0.1, off_seconds=0.1):
+        return cls.blink(on_seconds, off_seconds, repeat=count)
+
+    @classmethod
+    def fade(cls, period_seconds=2.0, steps=20, repeat=None):
+        # triangle wave of the duty cycle, from 0 to 100 and back, needs a PWM capable output
+        step = period_seconds / (2.0 * steps)
+        duty_cycles = [100.0 * i / steps for i in xrange(steps)] + [100.0 * (steps - i) / steps for i in xrange(steps)]
+        return cls([(i * step, duty_cycle) for i, duty_cycle in enumerate(duty_cycles)], period_seconds, repeat=repeat)
+
+    @classmethod
+    def morse(cls, text, unit_seconds=0.1, repeat=1):
+        # dot is one unit on, dash three; one unit off between symbols, three between letters, seven between words
+        transitions = []
+        t = 0
+        for word in text.upper().split():
+            for letter in word:
+                for symbol in cls.MORSE.get(letter, ''):
+                    transitions.append((t * unit_seconds, True))
+                    t += 1 if symbol == '.' else 3
+                    transitions.append((t * unit_seconds, False))
+                    t += 1
+                t += 2
+            t += 4
+        return cls(transitions, t * unit_seconds, repeat=repeat)
+
+
+class _Playback(object):
+    __slots__ = ('device', 'pattern', 'start', 'index', 'cycle', 'on_after_stop')
+
+    def __init__(self, device, pattern, start, on_after_stop):
+        self.device = device
+        self.pattern = pattern
+        self.start = start
+        self.index = 0
+        self.cycle = 0
+        self.on_after_stop = on_after_stop
+
+    def next_time(self):
+        # time of the next transition, or of the end of the pattern (index None)
+        if self.index is None:
+            return self.start + self.cycle * self.pattern.duration
+        return self.start + self.cycle * self.pattern.duration + self.pattern.transitions[self.index][0]
+
+
+class Sequencer(object):
+    # Plays patterns on any number of output devices from a single thread. Upcoming transitions are kept in a heap,
+    # and all those due within 'resolution' seconds are applied together: on/off changes to plain outputs are written
+    # with a single GPIO.output call for all their pins, so that synchronized patterns change at the same instant.
+    def __init__(self, resolution=0.001):
+        self.resolution = resolution
+        self.condition = Condition()
+        self.heap = []
+        self.sequence = count()
+        self.playing = {}
+        self.running = True
+        self.thread = Thread(target=self._run, name='Sequencer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def play(self, device, pattern, on_after_stop=False, start=None):
+        # patterns given the same start time stay in sync
+        if not pattern.transitions:
+            return
+        with self.condition:
+            playback = _Playback(device, pattern, time() if start is None else start, on_after_stop)
+            self.playing[device] = playback
+            heappush(self.heap, (playback.next_time(), next(self.sequence), playback))
+            self.condition.notify()
+
+    def stop(self, device, on_after_stop=False):
+        with self.condition:
+            if self.playing.pop(device, None) is not None:
+                self._finish(device, on_after_stop)
+
+    def is_playing(self, device):
+        return device in self.playing
+
+    def shutdown(self):
+        for device in list(self.playing):
+            self.stop(device)
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+
+    def _finish(self, device, on):
+        device.stop_pwm()
+        GPIO.output(device.pin, device.level(on))
+
+    def _advance(self, playback):
+        playback.index += 1
+        if playback.index == len(playback.pattern.transitions):
+            playback.index = 0
+            playback.cycle += 1
+            if playback.pattern.repeat is not None and playback.cycle >= playback.pattern.repeat:
+                playback.index = None
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.running and (not self.heap or self.heap[0][0] > time()):
+                    self.condition.wait(self.heap[0][0] - time() if self.heap else None)
+                if not self.running:
+                    return
+                values = {}
+                finished = []
+                horizon = time() + self.resolution
+                while self.heap and self.heap[0][0] <= horizon:
+                    _, _, playback = heappop(self.heap)
+                    if self.playing.get(playback.device) is not playback:
+                        continue  # stopped or replaced
+                    if playback.index is None:
+                        del self.playing[playback.device]
+                        finished.append(playback)
+                        continue
+                    values[playback.device] = playback.pattern.transitions[playback.index][1]
+                    self._advance(playback)
+                    heappush(self.heap, (playback.next_time(), next(self.sequence), playback))
+                self._write(values)
+                for playback in finished:
+                    self._finish(playback.device, playback.on_after_stop)
+
+    def _write(self, values):
+        pins = []
+        levels = []
+        for device, value in values.items():
+            if isinstance(value, bool) and not device.pwm_output:
+                device.stop_pwm()
+                pins.append(device.pin)
+                levels.append(device.level(value))
+            elif isinstance(value, bool):
+                device.set_duty_cycle(device.on_duty_cycle if value else 0)
+            else:
+                device.set_duty_cycle(value)
+        if pins:
+            GPIO.output(pins, levels)
@@ -0,0 +1,125 @@
+from heapq import heappop, heappush
+from itertools import count
+import logging
+from threading import Condition, Thread
+from time import time
+
+import metrics
+
+
+log = logging.getLogger(__name__)
+
+
+class Job(object):
+    __slots__ = ('func', 'args', 'interval', 'cancelled')
+
+    def __init__(self, func, args, interval=None):
+        self.func = func
+        self.args = args
+        self.interval = interval
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class DeviceRuntime(object):
+    # Runs the periodic and edge-driven work of any number of devices on a single thread, from a heap of deadlines.
+    # Devices passed runtime=... register their work here (see ThreadedDigitalInputDevice.attach) instead of each
+    # running its own thread. call_soon() is thread-safe, so GPIO edge callbacks use it to hand work to the loop.
+    def __init__(self, name='DeviceRuntime'):
+        self.name = name
+        self.condition = Condition()
+        self.heap = []
+        self.sequence = count()  # tie breaker, so jobs with the same deadline run in scheduling order
+        self.devices = []
+        self.thread = None
+        self.running = False
+        registry = metrics.get_registry()
+        self.metrics_enabled = registry.enabled
+        self.lateness = registry.histogram(
+            'runtime_job_lateness_seconds', 'How late jobs started after their deadline', runtime=name
+        )
+        self.job_duration = registry.histogram('runtime_job_seconds', 'Job run time', runtime=name)
+
+    def _push(self, deadline, job):
+        with self.condition:
+            heappush(self.heap, (deadline, next(self.sequence), job))
+            self.condition.notify()
+        return job
+
+    def call_soon(self, func, *args):
+        return self._push(0, Job(func, args))
+
+    def call_later(self, delay, func, *args):
+        return self._push(time() + delay, Job(func, args))
+
+    def schedule_periodic(self, interval, func, *args):
+        # first run after 'interval', then every 'interval' seconds, on a fixed schedule that doesn't drift
+        return self._push(time() + interval, Job(func, args, interval=interval))
+
+    def add_device(self, device):
+        self.devices.append(device)
+        device.attach(self)
+
+    def remove_device(self, device):
+        if device in self.devices:
+            self.devices.remove(device)
+            device.detach()
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = Thread(target=self._run, name=self.name)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        for device in list(self.devices):
+            device.stop()
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def _next_job(self):
+        with self.condition:
+            while self.running:
+                if self.heap:
+                    deadline, _, job = self.heap[0]
+                    if job.cancelled:
+                        heappop(self.heap)
+                        continue
+                    now = time()
+                    if deadline <= now:
+                        heappop(self.heap)
+                        if deadline:  # not call_soon()
+                            self.lateness.observe(now - deadline)
+                        if job.interval is not None:
+                            # skip missed periods rather than running them back to back
+                            deadline += job.interval
+                            if deadline <= now:
+                                deadline = now + job.interval
+                            heappush(self.heap, (deadline, next(self.sequence), job))
+                        return job
+                    self.condition.wait(deadline - now)
+                else:
+                    self.condition.wait()
+        return None
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                break
+            try:
+                if self.metrics_enabled:
+                    start = time()
+                    job.func(*job.args)
+                    self.job_duration.observe(time() - start)
+                else:
+                    job.func(*job.args)
+            except Exception:
+                log.exception('{}: error running {}'.format(self.name, job.func))
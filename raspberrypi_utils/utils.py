@@ -1,71 +1,408 @@
 import ConfigParser
+import ctypes
+import ctypes.util
+import importlib
+import json
 import logging
+import os
+from Queue import Empty, Full, Queue
 import smtplib
+import socket
+import tempfile
+from threading import Event, Lock, Thread
+from time import time
+
+import metrics
 
 
 log = logging.getLogger(__name__)
 
 
-def send_gmail(email_from, password, emails_to, subject, body):
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2 has no monotonic clock, call clock_gettime(CLOCK_MONOTONIC) directly
+    class _timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    _CLOCK_MONOTONIC = 1
     try:
-        gmail = smtplib.SMTP_SSL('smtp.gmail.com', 465)
-        gmail.ehlo()
-        gmail.login(email_from, password)
-        email_text = '''\
+        _clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True).clock_gettime
+        _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+    except (OSError, AttributeError):
+        _clock_gettime = None
+
+    def monotonic():
+        if _clock_gettime is None:
+            return time()
+        t = _timespec()
+        if _clock_gettime(_CLOCK_MONOTONIC, ctypes.pointer(t)) != 0:
+            return time()
+        return t.tv_sec + t.tv_nsec * 1e-9
+
+
+class LazyModule(object):
+    # Imports the module at first attribute access, so that importing this package doesn't import dependencies
+    # (numpy, Adafruit_GPIO, arrow) that may never be used, or not be installed (off a Raspberry Pi).
+    # Attributes are cached once looked up.
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        value = getattr(importlib.import_module(self._name), attr)
+        self.__dict__[attr] = value
+        return value
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def _format_email(email_from, emails_to, subject, body):
+    return '''\
 From: {email_from}
 To: {to}
 Subject: {subject}
 
 {body}
 '''.format(email_from=email_from, to=emails_to, subject=subject, body=body)
+
+
+def _is_transient_smtp_error(e):
+    # dropped connections and 4xx replies may succeed later, 5xx replies are permanent
+    if isinstance(e, (smtplib.SMTPServerDisconnected, socket.error)):
+        return True
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in e.recipients.values())
+    if isinstance(e, smtplib.SMTPResponseException):
+        return 400 <= e.smtp_code < 500
+    return False
+
+
+def send_gmail(email_from, password, emails_to, subject, body):
+    try:
+        gmail = smtplib.SMTP_SSL('smtp.gmail.com', 465)
+        gmail.ehlo()
+        gmail.login(email_from, password)
+        email_text = _format_email(email_from, emails_to, subject, body)
         gmail.sendmail(email_from, emails_to, email_text)
         gmail.quit()
         log.debug('Email "{}" sent to {}'.format(subject, emails_to))
         return True
     except smtplib.SMTPException:
+        metrics.get_registry().counter(
+            'emails_failed_total', 'Emails that could not be sent', host='smtp.gmail.com'
+        ).inc()
+        return False
+
+
+class EmailNotifier(object):
+    # Sends emails from a background thread, over one persistent SMTP connection that is reused between emails,
+    # reconnected when the server drops it, and closed after idle_seconds without emails. send() only queues the
+    # email (in a queue of queue_size) so callers never wait on the network; sends failing on a dropped connection
+    # or a 4xx reply are retried up to max_retries times, backing off exponentially from backoff_seconds, 5xx replies
+    # fail at once. With password None, there is no login, e.g. for a local smtpd test server (use_ssl=False).
+    def __init__(self, email_from, password, host='smtp.gmail.com', port=465, use_ssl=True, queue_size=100,
+                 max_retries=3, backoff_seconds=1.0, idle_seconds=60, timeout=30):
+        self.email_from = email_from
+        self.password = password
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.idle_seconds = idle_seconds
+        self.timeout = timeout
+        self.queue = Queue(queue_size)
+        self.connection = None
+        self.last_activity = time()
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        registry = metrics.get_registry()
+        self.sent_counter = registry.counter('emails_sent_total', 'Emails sent', host=host)
+        self.failed_counter = registry.counter('emails_failed_total', 'Emails that could not be sent', host=host)
+        self.dropped_counter = registry.counter('emails_dropped_total', 'Emails dropped, queue full', host=host)
+        self.retries_counter = registry.counter('email_retries_total', 'Failed email sending attempts', host=host)
+        self.stop_event = Event()
+        self.thread = Thread(target=self._run, name='EmailNotifier')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def send(self, emails_to, subject, body):
+        # returns False if the queue is full and the email was dropped
+        try:
+            self.queue.put_nowait((emails_to, subject, body))
+            return True
+        except Full:
+            self.dropped += 1
+            self.dropped_counter.inc()
+            log.warning('Email queue full, dropping "{}" to {}'.format(subject, emails_to))
+            return False
+
+    def stop(self, timeout=None):
+        # stop after sending the emails already queued
+        self.stop_event.set()
+        self.thread.join(timeout)
+
+    def _connect(self):
+        if self.use_ssl:
+            connection = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout)
+        else:
+            connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        connection.ehlo()
+        if self.password is not None:
+            connection.login(self.email_from, self.password)
+        self.connection = connection
+
+    def _disconnect(self):
+        if self.connection is not None:
+            try:
+                self.connection.quit()
+            except (smtplib.SMTPException, socket.error):
+                pass
+            self.connection = None
+
+    def _send(self, emails_to, subject, body):
+        email_text = _format_email(self.email_from, emails_to, subject, body)
+        attempt = 0
+        while True:
+            reused = self.connection is not None
+            try:
+                if self.connection is None:
+                    self._connect()
+                self.connection.sendmail(self.email_from, emails_to, email_text)
+                self.sent += 1
+                self.sent_counter.inc()
+                log.debug('Email "{}" sent to {}'.format(subject, emails_to))
+                return True
+            except (smtplib.SMTPException, socket.error) as e:
+                self._disconnect()
+                if reused and isinstance(e, (smtplib.SMTPServerDisconnected, socket.error)):
+                    # the server dropped the idle connection, reconnect straight away
+                    log.debug('SMTP connection lost ({}), reconnecting'.format(e))
+                    continue
+                log.warning('Sending email "{}" failed (attempt {}): {}'.format(subject, attempt + 1, e))
+                self.retries_counter.inc()
+                if attempt >= self.max_retries or not _is_transient_smtp_error(e):
+                    break
+                self.stop_event.wait(self.backoff_seconds * 2 ** attempt)
+                attempt += 1
+        self.failed += 1
+        self.failed_counter.inc()
         return False
 
+    def _run(self):
+        while not (self.stop_event.is_set() and self.queue.empty()):
+            try:
+                email = self.queue.get(timeout=min(self.idle_seconds, 1))
+            except Empty:
+                if self.connection is not None and time() - self.last_activity >= self.idle_seconds:
+                    self._disconnect()
+                continue
+            self._send(*email)
+            self.last_activity = time()
+        self._disconnect()
+
+
+def _to_list(x, convert):
+    x = x.strip('[], ')
+    if ',' in x:
+        return [convert(elem.strip()) for elem in x.split(',')]
+    return [convert(x)]
+
+
+# Value conversion for each key suffix, e.g. 'RETRIES_INT' is converted with int() and stored as 'RETRIES'
+TYPE_CONVERSION_MAP = {
+    'STR': lambda x: str(x),
+    'INT': lambda x: int(x),
+    'FLOAT': lambda x: float(x),
+    'BOOL': lambda x: x.lower() == 'true',
+    'STRLIST': lambda x: _to_list(x, str),
+    'INTLIST': lambda x: _to_list(x, int),
+    'FLOATLIST': lambda x: _to_list(x, float),
+}
+
+
+def parse_config(path):
+    parser = ConfigParser.ConfigParser()
+    parser.read(path)
+    config = {}
+    for section in parser.sections():
+        config[section] = {}
+        for (key, value) in parser.items(section):
+            key, _, suffix = key.upper().rpartition('_')
+            func = TYPE_CONVERSION_MAP.get(suffix)
+            if func is None:
+                log.debug('Unrecognized type in key {}_{}, ignoring'.format(key, suffix))
+                continue
+            try:
+                config[section][key] = func(value)
+                log.debug('{} = {}'.format(key, config[section][key]))
+            except ValueError:
+                log.debug('Cannot convert value {} in key {}, ignoring'.format(value, key))
+    return config
+
+
+class ConfigService(object):
+    # Typed configuration from an ini file (see parse_config), parsed once and cached until the file's
+    # modification time, inode or size change. Subscribers are called with the changes, as
+    # {section: {key: new value or None if removed}}, or just {key: value} when subscribed to one section.
+    # Changes are picked up by get() or check(), or by a thread polling the file every poll_seconds.
+    _shared = {}
+
+    def __init__(self, path='config.ini', poll_seconds=None):
+        self.path = path
+        self.lock = Lock()
+        self.signature = None
+        self.config = {}
+        self.subscribers = []
+        self.stop_event = Event()
+        self.thread = None
+        self.check()
+        if poll_seconds:
+            self.thread = Thread(target=self._poll, args=(poll_seconds,), name='ConfigService')
+            self.thread.daemon = True
+            self.thread.start()
+
+    @classmethod
+    def shared(cls, path='config.ini'):
+        # one service per file, shared by everything reading it
+        key = os.path.abspath(path)
+        service = cls._shared.get(key)
+        if service is None:
+            service = cls._shared[key] = cls(key)
+        return service
+
+    def _signature(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime, st.st_ino, st.st_size
+
+    def get(self):
+        self.check()
+        with self.lock:
+            return dict((section, dict(values)) for section, values in self.config.items())
+
+    def subscribe(self, callback, section=None):
+        self.subscribers.append((callback, section))
+
+    def unsubscribe(self, callback):
+        self.subscribers = [(c, s) for c, s in self.subscribers if c != callback]
+
+    def check(self):
+        # reload if the file changed, returns the changes
+        signature = self._signature()
+        with self.lock:
+            if signature == self.signature:
+                return {}
+            self.signature = signature
+            old = self.config
+            self.config = parse_config(self.path) if signature is not None else {}
+            changes = self._diff(old, self.config)
+        if changes:
+            log.debug('Configuration {} changed: {}'.format(self.path, changes))
+            for callback, section in self.subscribers:
+                if section is None:
+                    callback(changes)
+                elif section in changes:
+                    callback(changes[section])
+        return changes
+
+    @staticmethod
+    def _diff(old, new):
+        changes = {}
+        for section in set(old) | set(new):
+            old_values = old.get(section, {})
+            new_values = new.get(section, {})
+            changed = dict(
+                (key, new_values.get(key))
+                for key in set(old_values) | set(new_values)
+                if old_values.get(key) != new_values.get(key)
+            )
+            if changed:
+                changes[section] = changed
+        return changes
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _poll(self, poll_seconds):
+        while not self.stop_event.wait(poll_seconds):
+            try:
+                self.check()
+            except Exception:
+                log.exception('Error reloading configuration {}'.format(self.path))
+
 
 class ReadConfigMixin(object):
     @staticmethod
     def read_config():
-        parser = ConfigParser.ConfigParser()
-        parser.read('config.ini')
-        config = {}
-        type_conversion_map = {
-            'STR': lambda x: str(x),
-            'INT': lambda x: int(x),
-            'FLOAT': lambda x: float(x),
-            'BOOL': lambda x: x.lower() == 'true',
-            'STRLIST': lambda x: (
-                [elem.strip() for elem in value.strip('[], ').split(',')]
-                if ',' in x
-                else [str(x.strip('[], '))]
-            ),
-            'INTLIST': lambda x: (
-                [int(elem.strip()) for elem in value.strip('[], ').split(',')]
-                if ',' in x
-                else [int(x.strip('[], '))]
-            ),
-        }
-        for section in parser.sections():
-            config[section] = {}
-            for (key, value) in parser.items(section):
-                key = key.upper()
-                converted = False
-                for t, func in type_conversion_map.iteritems():
-                    if key.endswith('_{}'.format(t)):
-                        key = key[:-(len(t)+1)]
-                        try:
-                            value = func(value)
-                            converted = True
-                        except ValueError:
-                            converted = None
-                            log.debug('Cannot convert value {} in key {}, ignoring'.format(value, key))
-                        break
-                if converted:
-                    config[section][key] = value
-                    log.debug('{} = {}'.format(key, value))
-                elif converted is not None:
-                    log.debug('Unrecognized type in key {}, ignoring'.format(key))
-        return config
+        return ConfigService.shared('config.ini').get()
+
+
+class CalibrationCache(object):
+    # Small JSON file of calibration results, so a restart doesn't need to recalibrate
+    DEFAULT_PATH = '~/.raspberrypi_utils/calibration.json'
+
+    def __init__(self, path=DEFAULT_PATH, max_age_seconds=24 * 60 * 60):
+        self.path = os.path.expanduser(path)
+        self.max_age_seconds = max_age_seconds
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self, entries):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # a temporary file of our own, so concurrent saves (other sensors or processes) never rename each other's
+        fd, tmp_path = tempfile.mkstemp(prefix='.calibration-', suffix='.tmp', dir=directory or '.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f)
+            os.rename(tmp_path, self.path)  # atomic, a crash never leaves a truncated cache behind
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def get(self, key):
+        entry = self._load().get(key)
+        if entry is None:
+            return None
+        if self.max_age_seconds is not None and time() - entry.get('timestamp', 0) > self.max_age_seconds:
+            log.debug('Calibration for {} is stale, ignoring'.format(key))
+            return None
+        return entry
+
+    def put(self, key, **values):
+        entries = self._load()
+        values['timestamp'] = time()
+        entries[key] = values
+        try:
+            self._save(entries)
+        except (IOError, OSError) as e:
+            log.warning('Cannot write calibration cache {}: {}'.format(self.path, e))
+
+    def invalidate(self, key=None):
+        entries = self._load()
+        if key is None:
+            entries = {}
+        elif entries.pop(key, None) is None:
+            return
+        try:
+            self._save(entries)
+        except (IOError, OSError) as e:
+            log.warning('Cannot write calibration cache {}: {}'.format(self.path, e))